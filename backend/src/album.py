@@ -0,0 +1,66 @@
+from dedup import hamming_distance
+
+
+class AlbumEntry:
+    def __init__(self, frame_no, score, frame_hash):
+        self.frame_no = frame_no
+        self.score = score
+        self.frame_hash = frame_hash
+        self.name = f"frame_{frame_no:06d}.jpg"
+
+
+class IncrementalAlbum:
+    """解析中に確定したベストショットを最大 size 枚まで保持し、より良いものが来たら入れ替える
+
+    見た目がほぼ同じフレーム（dHashのハミング距離が max_distance 以下）は1枚だけ残す。
+    """
+
+    def __init__(self, size, max_distance=6):
+        self.size = size
+        self.max_distance = max_distance
+        self.entries = []
+
+    def is_similar(self, entry, frame_hash):
+        return (
+            self.max_distance is not None
+            and hamming_distance(entry.frame_hash, frame_hash) <= self.max_distance
+        )
+
+    def plan(self, score, frame_hash):
+        """追加できる場合は入れ替えで外れるエントリのリストを、できない場合はNoneを返す"""
+        similar = [e for e in self.entries if self.is_similar(e, frame_hash)]
+        if any(e.score >= score for e in similar):
+            return None
+        evicted = similar
+        remaining = [e for e in self.entries if e not in evicted]
+        if len(remaining) >= self.size:
+            worst = min(remaining, key=lambda e: e.score)
+            if worst.score >= score:
+                return None
+            evicted = evicted + [worst]
+        return evicted
+
+    def state(self):
+        """チェックポイントに保存するエントリの一覧を返す"""
+        return [
+            {
+                "frame_no": e.frame_no,
+                "score": e.score,
+                "hash": e.frame_hash,
+                "name": e.name,
+            }
+            for e in self.entries
+        ]
+
+    def restore(self, state):
+        self.entries = []
+        for item in state:
+            entry = AlbumEntry(item["frame_no"], item["score"], item["hash"])
+            entry.name = item["name"]
+            self.entries.append(entry)
+
+    def add(self, frame_no, score, frame_hash, evicted):
+        self.entries = [e for e in self.entries if e not in evicted]
+        entry = AlbumEntry(frame_no, score, frame_hash)
+        self.entries.append(entry)
+        return entry
@@ -0,0 +1,77 @@
+import threading
+
+from dedup import DuplicateFilter
+
+
+class BatchJob:
+    """1つのアルバムIDにまとめてアップロードされた複数の動画の解析状況を管理する
+
+    動画ごとの解析はスケジューラーで並行に実行し、最後の動画が終わったらアルバムを作る。
+    """
+
+    def __init__(self, album_id, job_dir, videos):
+        self.album_id = album_id
+        self.job_dir = job_dir
+        self.videos = videos
+        self.processors = [None] * len(videos)
+        self.errors = []
+        self.remaining = len(videos)
+        self.lock = threading.Lock()
+
+    def finish_video(self, index, processor=None, error=None):
+        """動画の解析結果を登録し、全ての動画が終わった場合にTrueを返す"""
+        with self.lock:
+            if error is not None:
+                self.errors.append(f"{self.videos[index]}: {error}")
+            self.processors[index] = processor
+            self.remaining -= 1
+            return self.remaining == 0
+
+
+def build_album(processors, smile_detector, dedup_distance=6, batch_size=16):
+    """全動画の候補を1つに順位付けし、重複を除いてまとめて笑顔判定・アップロードする"""
+    candidates = [
+        (eye_ratio, index, frame_no)
+        for index, processor in enumerate(processors)
+        if processor is not None
+        for frame_no, eye_ratio in processor.ranked_candidates()
+    ]
+    candidates.sort(key=lambda c: c[0], reverse=True)
+
+    duplicate_filter = (
+        DuplicateFilter(max_distance=dedup_distance)
+        if dedup_distance is not None
+        else None
+    )
+    uploaded = 0
+    pending = []
+    for _, index, frame_no in candidates:
+        processor = processors[index]
+        frame = processor.decoder.read(frame_no)
+        if frame is None:
+            continue
+        # 別の動画でも見た目がほぼ同じフレームは、順位が最も高い1枚だけを残す
+        if duplicate_filter is not None and duplicate_filter.is_duplicate(frame):
+            continue
+        pending.append(
+            (index, frame_no, frame, processor.scale_face_boxes(frame_no, frame))
+        )
+        if len(pending) == batch_size:
+            uploaded += upload_smiles(processors, smile_detector, pending)
+            pending = []
+    if pending:
+        uploaded += upload_smiles(processors, smile_detector, pending)
+    return uploaded
+
+
+def upload_smiles(processors, smile_detector, pending):
+    results = smile_detector.process_batch(
+        [(frame, faces) for _, _, frame, faces in pending]
+    )
+    uploaded = 0
+    for (index, frame_no, frame, _), smiling in zip(pending, results):
+        if smiling and processors[index].upload_frame(
+            frame_no, frame, f"video{index:02d}_frame_{frame_no:06d}.jpg"
+        ):
+            uploaded += 1
+    return uploaded
@@ -0,0 +1,382 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def summarize(name, latencies):
+    latencies = np.array(latencies) * 1000
+    total = latencies.sum() / 1000
+    print(
+        f"{name}: n={len(latencies)}, mean={latencies.mean():.1f}ms, "
+        f"p50={np.percentile(latencies, 50):.1f}ms, "
+        f"p95={np.percentile(latencies, 95):.1f}ms, "
+        f"throughput={len(latencies) / total:.2f}/s"
+    )
+
+
+def load_fixture_images(fixtures):
+    paths = sorted(
+        p
+        for ext in ("jpg", "jpeg", "png")
+        for p in glob.glob(os.path.join(fixtures, f"*.{ext}"))
+    )
+    return [(path, cv2.imread(path)) for path in paths]
+
+
+def bench_emotion(args):
+    """py-featとONNXバックエンドの笑顔判定の一致率と速度を比較する
+
+    py-featの判定を基準に、ONNXの顔検出から行う経路、dlibの顔領域を渡す経路、
+    顔領域つきでまとめて推論する process_batch の経路（py-feat・ONNX）の一致率を求める。
+    いずれかが --min-agreement を下回った場合は終了コード1で終わる。
+    """
+    from smile_detect import EmotionDetector
+
+    images = load_fixture_images(args.fixtures)
+    if not images:
+        print(f"画像が見つかりません: {args.fixtures}")
+        return
+
+    feat_detector = EmotionDetector(device="cpu", backend="feat")
+    onnx_detector = EmotionDetector(backend="onnx", onnx_model_path=args.model)
+    # 解析時と同じく、顔領域はdlibで検出したものを渡す
+    boxes = [onnx_detector.classifier.detect_faces(image) for _, image in images]
+
+    # ウォームアップ
+    feat_detector.process_single_image2(images[0][1])
+    onnx_detector.process_single_image2(images[0][1])
+
+    feat_results, feat_latencies = [], []
+    for _, image in images:
+        start = time.perf_counter()
+        feat_results.append(feat_detector.process_single_image2(image))
+        feat_latencies.append(time.perf_counter() - start)
+    summarize("feat", feat_latencies)
+
+    runs = [
+        ("onnx", lambda i, image: onnx_detector.process_single_image2(image)),
+        (
+            "onnx (顔領域指定)",
+            lambda i, image: onnx_detector.process_single_image2(image, boxes[i]),
+        ),
+        (
+            "feat (バッチ)",
+            lambda i, image: feat_detector.process_batch([(image, boxes[i])])[0],
+        ),
+        (
+            "onnx (バッチ)",
+            lambda i, image: onnx_detector.process_batch([(image, boxes[i])])[0],
+        ),
+    ]
+    failed = []
+    for name, run in runs:
+        latencies, matches = [], 0
+        for i, (path, image) in enumerate(images):
+            start = time.perf_counter()
+            result = run(i, image)
+            latencies.append(time.perf_counter() - start)
+
+            matches += result == feat_results[i]
+            if result != feat_results[i]:
+                print(f"不一致 [{name}]: {path} (feat={feat_results[i]}, {result})")
+        agreement = matches / len(images)
+        print(f"判定一致率 [{name}]: {matches}/{len(images)} ({agreement:.1%})")
+        summarize(name, latencies)
+        if agreement < args.min_agreement:
+            failed.append(name)
+
+    if failed:
+        print(f"一致率が{args.min_agreement:.0%}を下回りました: {', '.join(failed)}")
+        sys.exit(1)
+
+
+def bench_decode(args):
+    """OpenCVとPyAVのデコード速度を比較する"""
+    from decoder import open_decoder
+
+    for name in ("opencv", "pyav"):
+        options = {"width": args.width, "stride": args.stride}
+        if name == "pyav":
+            options["keyframes_only"] = args.keyframes_only
+        decoder = open_decoder(name, args.video, **options)
+        start = time.perf_counter()
+        count = sum(1 for _ in decoder.frames())
+        elapsed = time.perf_counter() - start
+        decoder.close()
+        print(f"{name}: {count}フレーム, {elapsed:.2f}s, {count / elapsed:.1f}fps")
+
+
+def synthetic_pose_sequence(frames, faces, size, seed=0):
+    """なめらかに動く複数の顔の68点ランドマーク列と、真の (yaw, pitch, roll) を生成する"""
+    from pose import (
+        LANDMARK_INDICES,
+        MODEL_POINTS,
+        camera_intrinsics,
+        euler_angles,
+        rotation_matrices,
+    )
+
+    rng = np.random.default_rng(seed)
+    camera_matrix, dist_coeffs = camera_intrinsics(size)
+    angles = rng.uniform(-0.5, 0.5, (faces, 3))
+    velocity = rng.uniform(-0.01, 0.01, (faces, 3))
+    offsets = np.linspace(-300, 300, faces)
+    sequence, truth = [], []
+    for _ in range(frames):
+        angles += velocity
+        shapes = []
+        for face in range(faces):
+            points, _ = cv2.projectPoints(
+                MODEL_POINTS,
+                angles[face],
+                np.array([offsets[face], 0.0, 1500.0]),
+                camera_matrix,
+                dist_coeffs,
+            )
+            shape = np.zeros((68, 2), dtype=int)
+            noise = rng.normal(0, 0.5, (len(LANDMARK_INDICES), 2))
+            shape[LANDMARK_INDICES] = np.round(points.reshape(-1, 2) + noise)
+            shapes.append(shape)
+        sequence.append(shapes)
+        truth.append(np.stack(euler_angles(rotation_matrices(angles)), axis=1))
+    return sequence, np.concatenate(truth)
+
+
+def angle_errors(estimates, truth):
+    errors = np.abs(estimates - truth) % 360
+    return np.minimum(errors, 360 - errors)
+
+
+def bench_pose(args):
+    """既存のestimate_head_poseとPoseEngineの速度と、真値に対する角度誤差を比較する"""
+    from pose import PoseEngine, estimate_head_pose
+
+    size = (562, 1000)
+    sequence, truth = synthetic_pose_sequence(args.frames, args.faces, size)
+    total = args.frames * args.faces
+
+    start = time.perf_counter()
+    reference = [
+        estimate_head_pose(shape, size) for shapes in sequence for shape in shapes
+    ]
+    reference_time = time.perf_counter() - start
+    reference = np.array(
+        [[np.ravel(angle)[0] for angle in angles] for angles in reference]
+    )
+
+    engine = PoseEngine()
+    start = time.perf_counter()
+    results = [engine.estimate(shapes, size) for shapes in sequence]
+    engine_time = time.perf_counter() - start
+    results = np.concatenate([np.stack(result, axis=1) for result in results])
+
+    for name, elapsed, estimates in (
+        ("estimate_head_pose", reference_time, reference),
+        ("PoseEngine", engine_time, results),
+    ):
+        errors = angle_errors(estimates, truth)
+        print(
+            f"{name}: {elapsed / total * 1e6:.1f}us/顔, "
+            f"誤差 (yaw, pitch, roll) 中央値={np.median(errors, axis=0).round(3)}, "
+            f"5度以上外れた割合={np.mean(errors.max(axis=1) > 5):.1%}"
+        )
+    agreement = np.mean(angle_errors(reference, results).max(axis=1) < 1)
+    print(f"両者の差が1度未満の割合: {agreement:.1%}")
+
+
+def run_analysis_job(video, decoder, decoder_options, smile_detector, smile_checks=5):
+    """アップロードを除いた1ジョブ分の処理（解析・候補選択・笑顔判定）を行う"""
+    from face_processor import FaceProcessor
+
+    processor = FaceProcessor(
+        video,
+        decoder=decoder,
+        decoder_options=decoder_options,
+        smile_detector=smile_detector,
+    )
+    processor.analyze_frames()
+    for frame_no in processor.select_peak_frames()[:smile_checks]:
+        frame = processor.decoder.read(frame_no)
+        if frame is not None:
+            faces = processor.scale_face_boxes(frame_no, frame)
+            smile_detector.process_single_image2(frame, faces)
+    processor.decoder.close()
+
+
+def bench_threads_worker(args):
+    """1つの設定（同時実行数 × スレッド数）をこのプロセス内で計測する"""
+    from resources import ResourceProfile
+
+    profile = ResourceProfile(
+        concurrent_jobs=args.concurrency, cores=args.concurrency * args.threads
+    )
+    # numpyとcv2は読み込み済みのため、スレッド数の環境変数はbench_threadsから渡す
+    profile.set_env()
+
+    from smile_detect import EmotionDetector
+
+    smile_detector = EmotionDetector(
+        device="cpu",
+        backend=args.backend,
+        onnx_model_path=args.model,
+        onnx_session_options=(
+            profile.session_options() if args.backend == "onnx" else None
+        ),
+    )
+    profile.apply()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(
+                run_analysis_job,
+                args.video,
+                args.decoder,
+                profile.decoder_options(),
+                smile_detector,
+            )
+            for _ in range(args.jobs)
+        ]
+        for future in futures:
+            future.result()
+    print(json.dumps({"elapsed": time.perf_counter() - start}))
+
+
+def bench_threads(args):
+    """同時実行数とジョブあたりのスレッド数を変えて、1分あたりの処理ジョブ数を比較する"""
+    from resources import THREAD_ENV_VARS
+
+    for concurrency in args.concurrency:
+        for threads in args.threads:
+            command = [
+                sys.executable,
+                os.path.abspath(__file__),
+                "threads-worker",
+                "--video",
+                args.video,
+                "--decoder",
+                args.decoder,
+                "--backend",
+                args.backend,
+                "--concurrency",
+                str(concurrency),
+                "--threads",
+                str(threads),
+                "--jobs",
+                str(args.jobs),
+            ]
+            if args.model:
+                command += ["--model", args.model]
+            # スレッド数の環境変数はimport前にしか効かないため、起動時の環境で渡す
+            env = dict(os.environ, **{name: str(threads) for name in THREAD_ENV_VARS})
+            result = subprocess.run(
+                command, capture_output=True, text=True, check=True, env=env
+            )
+            elapsed = json.loads(result.stdout.strip().splitlines()[-1])["elapsed"]
+            print(
+                f"同時実行={concurrency}, スレッド/ジョブ={threads}: "
+                f"{args.jobs * 60 / elapsed:.2f} jobs/min"
+            )
+
+
+def bench_frames(args):
+    """フレームループ1回あたりのメモリ確保量と処理時間をtracemallocで計測する"""
+    from face_processor import FaceProcessor
+    from profiling import FrameProfiler
+    from smile_detect import EmotionDetector
+
+    profiler = FrameProfiler(top=args.top, sample_interval=args.sample_interval)
+    processor = FaceProcessor(
+        args.video,
+        decoder=args.decoder,
+        smile_detector=EmotionDetector(
+            device="cpu", backend=args.backend, onnx_model_path=args.model
+        ),
+        profiler=profiler,
+    )
+    processor.analyze()
+    processor.close()
+    profiler.report()
+
+
+def add_job_arguments(parser):
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--decoder", default="pyav")
+    parser.add_argument("--backend", default="feat")
+    parser.add_argument("--model")
+    parser.add_argument("--jobs", type=int, default=8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="happy-shot backend benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    emotion = subparsers.add_parser("emotion", help="笑顔判定バックエンドの比較")
+    emotion.add_argument("--fixtures", required=True, help="顔画像のディレクトリ")
+    emotion.add_argument("--model", required=True, help="量子化済みONNXモデル")
+    emotion.add_argument(
+        "--min-agreement",
+        type=float,
+        default=0.95,
+        help="py-featとの判定一致率の下限（下回ると終了コード1）",
+    )
+    emotion.set_defaults(func=bench_emotion)
+
+    decode = subparsers.add_parser("decode", help="動画デコーダーの比較")
+    decode.add_argument("--video", required=True)
+    decode.add_argument("--width", type=int, default=1000)
+    decode.add_argument("--stride", type=int, default=1)
+    decode.add_argument("--keyframes-only", action="store_true")
+    decode.set_defaults(func=bench_decode)
+
+    pose = subparsers.add_parser("pose", help="頭部姿勢推定の比較")
+    pose.add_argument("--frames", type=int, default=300)
+    pose.add_argument("--faces", type=int, default=5)
+    pose.set_defaults(func=bench_pose)
+
+    threads = subparsers.add_parser("threads", help="CPUスレッド配分の比較")
+    add_job_arguments(threads)
+    threads.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    threads.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    threads.set_defaults(func=bench_threads)
+
+    frames = subparsers.add_parser("frames", help="フレームループのメモリ確保の計測")
+    frames.add_argument("--video", required=True)
+    frames.add_argument(
+        "--decoder",
+        default="opencv",
+        choices=["opencv", "pyav"],
+        help="サーバーの既定 (VIDEO_DECODER) と同じopencvではフレームバッファを使い回す",
+    )
+    frames.add_argument("--backend", default="feat")
+    frames.add_argument("--model")
+    frames.add_argument("--top", type=int, default=10)
+    frames.add_argument(
+        "--sample-interval",
+        type=int,
+        default=10,
+        help="確保ブロック数を数えるフレームの間隔",
+    )
+    frames.set_defaults(func=bench_frames)
+
+    # threadsから設定ごとに起動される内部用のサブコマンド
+    worker = subparsers.add_parser("threads-worker")
+    add_job_arguments(worker)
+    worker.add_argument("--concurrency", type=int, required=True)
+    worker.add_argument("--threads", type=int, required=True)
+    worker.set_defaults(func=bench_threads_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import cv2
+
+
+class DecodedFrame:
+    def __init__(self, index, timestamp, gray):
+        self.index = index
+        self.timestamp = timestamp
+        self.gray = gray
+
+
+class OpenCVDecoder:
+    """cv2.VideoCaptureで全解像度のままデコードし、縮小・グレースケール化する
+
+    変換先のバッファはフレーム間で使い回すため、返したgrayは次のフレームで上書きされる。
+    """
+
+    def __init__(self, source, width=1000, stride=1, keyframes_only=False, threads=0):
+        if keyframes_only:
+            raise ValueError(
+                "OpenCVデコーダーはキーフレームのみのデコードに未対応です。"
+            )
+        self.capture = cv2.VideoCapture(source)
+        self.width = width
+        self.stride = stride
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frame = None
+        self.small = None
+        self.gray = None
+
+    def frames(self, start=0):
+        if start > 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while self.capture.grab():
+            index += 1
+            # 間引いたフレームはretrieveしないことで変換コストを省く
+            if (index - 1) % self.stride:
+                continue
+            ret, self.frame = self.capture.retrieve(self.frame)
+            if not ret:
+                break
+            height = int(self.frame.shape[0] * self.width / self.frame.shape[1])
+            # サイズが同じなら前のフレームのバッファに書き込まれる
+            self.small = cv2.resize(
+                self.frame,
+                (self.width, height),
+                dst=self.small,
+                interpolation=cv2.INTER_AREA,
+            )
+            self.gray = cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            yield DecodedFrame(
+                index - 1,
+                self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000,
+                self.gray,
+            )
+
+    def read(self, index):
+        """指定したフレームを元の解像度のBGR画像で返す"""
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = self.capture.read()
+        return frame if ret else None
+
+    def close(self):
+        self.capture.release()
+
+
+class PyAVDecoder:
+    """PyAV (FFmpeg) でフレーム並列デコードし、swscaleで縮小・グレースケール化する"""
+
+    def __init__(self, source, width=1000, stride=1, keyframes_only=False, threads=0):
+        import av
+
+        self.container = av.open(source)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        if threads:
+            self.stream.thread_count = threads
+        if keyframes_only:
+            self.stream.codec_context.skip_frame = "NONKEY"
+
+        self.width = width
+        self.height = int(
+            self.stream.codec_context.height * width / self.stream.codec_context.width
+        )
+        self.stride = stride
+        rate = self.stream.average_rate or self.stream.guessed_rate
+        self.fps = float(rate) if rate else 30.0
+        self.time_base = self.stream.time_base
+        self.start_pts = self.stream.start_time or 0
+
+    def frame_index(self, frame):
+        # 浮動小数のフレーム位置ではなく、PTSから正確なフレーム番号を求める
+        return round(float((frame.pts - self.start_pts) * self.time_base) * self.fps)
+
+    def seek(self, index):
+        pts = int(index / self.fps / self.time_base) + self.start_pts
+        self.container.seek(pts, stream=self.stream, backward=True)
+
+    def frames(self, start=0):
+        if start > 0:
+            self.seek(start)
+        for frame in self.container.decode(self.stream):
+            if frame.pts is None:
+                continue
+            index = self.frame_index(frame)
+            if index < start or index % self.stride:
+                continue
+            gray = frame.reformat(
+                width=self.width, height=self.height, format="gray"
+            ).to_ndarray()
+            yield DecodedFrame(index, float(frame.time), gray)
+
+    def read(self, index):
+        """指定したフレームを元の解像度のBGR画像で返す"""
+        self.seek(index)
+        for frame in self.container.decode(self.stream):
+            if frame.pts is not None and self.frame_index(frame) >= index:
+                return frame.to_ndarray(format="bgr24")
+        return None
+
+    def close(self):
+        self.container.close()
+
+
+DECODERS = {"opencv": OpenCVDecoder, "pyav": PyAVDecoder}
+
+
+def open_decoder(name, source, **options):
+    if name not in DECODERS:
+        raise ValueError(f"未対応のデコーダーです: {name}")
+    return DECODERS[name](source, **options)
@@ -0,0 +1,35 @@
+import cv2
+import numpy as np
+
+
+def dhash(frame, hash_size=8):
+    """フレームの差分ハッシュ (dHash) を hash_size**2 ビットの整数で返す"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class DuplicateFilter:
+    """ハミング距離が近いフレームを同じクラスタとみなし、最初の1枚だけを通す
+
+    フレームはスコアの高い順に渡すことで、各クラスタの代表が最良のフレームになる。
+    """
+
+    def __init__(self, max_distance=6, hash_size=8):
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.hashes = []
+
+    def is_duplicate(self, frame):
+        frame_hash = dhash(frame, self.hash_size)
+        if any(
+            hamming_distance(frame_hash, h) <= self.max_distance for h in self.hashes
+        ):
+            return True
+        self.hashes.append(frame_hash)
+        return False
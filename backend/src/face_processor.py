@@ -1,15 +1,41 @@
-import tempfile
+import os
+from functools import lru_cache
 
 import cv2
 import dlib
-import imutils
-import matplotlib.pyplot as plt
 import numpy as np
 import requests
-from imutils import face_utils
 from scipy.ndimage import gaussian_filter1d
 
+from album import IncrementalAlbum
+from decoder import open_decoder
+from dedup import DuplicateFilter, dhash
+from frame_gate import FrameGate
+from pose import PoseEngine, estimate_head_pose
+from score_store import LandmarkStore, ScoreStore, eye_aspect_ratios
 from smile_detect import EmotionDetector
+from streaming import StreamingPeakSelector
+
+# 画像の保存先 (s3/main.go)。負荷試験ではローカルのスタブに向ける
+UPLOAD_URL = os.getenv(
+    "UPLOAD_URL",
+    "https://app-122ab23f-3126-4106-9d44-988a8bd962de.ingress.apprun.sakura.ne.jp/upload",
+)
+# アルバムから入れ替えで外れた画像の削除先
+DELETE_URL = os.getenv("DELETE_URL", UPLOAD_URL.rsplit("/", 1)[0] + "/images")
+
+
+def fill_landmarks(shape, out):
+    """dlibのランドマークを確保済みの (68, 2) 配列に書き込む"""
+    for i, point in enumerate(shape.parts()):
+        out[i] = point.x, point.y
+    return out
+
+
+@lru_cache(maxsize=None)
+def load_shape_predictor(predictor_path):
+    # 読み込みに時間がかかるため、ジョブ間で使い回す
+    return dlib.shape_predictor(predictor_path)
 
 
 class FaceInstance:
@@ -25,71 +51,172 @@ class FaceProcessor:
         video_source,
         predictor_path="src/shape_predictor_68_face_landmarks.dat",
         id="test",
+        emotion_backend="feat",
+        onnx_model_path=None,
+        analysis_width=1000,
+        motion_threshold=2.0,
+        dedup_distance=6,
+        smile_detector=None,
+        decoder="opencv",
+        decoder_options=None,
+        job_dir=None,
+        streaming_top_k=None,
+        eye_ar_threshold=0.2,
+        album_size=None,
+        profiler=None,
     ):
         self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor(predictor_path)
+        self.predictor = load_shape_predictor(predictor_path)
         self.video_source = video_source
         self.face_instances = []
-        self.capture = cv2.VideoCapture(video_source)
-        self.smile_detector = EmotionDetector()
-        self.id = id.lower()
-
-    def calculate_eye_aspect_ratio(self, eye):
-        A = np.linalg.norm(eye[1] - eye[5])
-        B = np.linalg.norm(eye[2] - eye[4])
-        C = np.linalg.norm(eye[0] - eye[3])
-        return (A + B) / (2.0 * C)
-
-    def estimate_head_pose(self, shape, frame):
-        size = frame.shape
-        focal_length = size[1]
-        center = (size[1] // 2, size[0] // 2)
-        camera_matrix = np.array(
-            [[focal_length, 0, center[0]], [0, focal_length, center[1]], [0, 0, 1]],
-            dtype="double",
+        self.face_boxes = {}
+        self.analysis_width = analysis_width
+        self.frame_gate = (
+            FrameGate(threshold=motion_threshold)
+            if motion_threshold is not None
+            else None
+        )
+        self.last_results = []
+        # 解析したフレームのランドマーク (顔の数, 68, 2)。顔が増えたときだけ確保し直す
+        self.landmarks = np.empty((0, 68, 2), dtype=np.int32)
+        self.profiler = profiler
+        self.pose_engine = PoseEngine()
+        self.dedup_distance = dedup_distance
+        self.decoder_name = decoder
+        self.decoder_options = decoder_options or {}
+        self.decoder = open_decoder(
+            decoder, video_source, width=analysis_width, **self.decoder_options
         )
-        dist_coeffs = np.zeros((4, 1))
-        model_points = np.array(
-            [
-                (0.0, 0.0, 0.0),
-                (-30.0, -125.0, -30.0),
-                (30.0, -125.0, -30.0),
-                (-60.0, -70.0, -60.0),
-                (60.0, -70.0, -60.0),
-                (-40.0, 40.0, -50.0),
-                (40.0, 40.0, -50.0),
-            ]
+        # 解析中に元解像度のフレームを読むためのデコーダー（解析側のシーク位置を崩さない）
+        self.frame_reader = None
+        self.smile_detector = smile_detector or EmotionDetector(
+            backend=emotion_backend, onnx_model_path=onnx_model_path
         )
-        image_points = np.array(
-            [
-                tuple(shape[30]),
-                tuple(shape[21]),
-                tuple(shape[22]),
-                tuple(shape[39]),
-                tuple(shape[42]),
-                tuple(shape[31]),
-                tuple(shape[35]),
-            ],
-            dtype="double",
+        self.id = id.lower()
+        # album_size を指定すると、極大フレームが確定するたびに判定・アップロードする
+        self.album = (
+            IncrementalAlbum(album_size, max_distance=dedup_distance)
+            if album_size is not None
+            else None
         )
-        success, rotation_vector, translation_vector = cv2.solvePnP(
-            model_points,
-            image_points,
-            camera_matrix,
-            dist_coeffs,
-            flags=cv2.SOLVEPNP_ITERATIVE,
+        # 長い動画では全フレームのスコアを保持せず、上位の極大フレームだけを残す
+        if streaming_top_k is None and self.album is not None:
+            streaming_top_k = album_size
+        self.peak_selector = (
+            StreamingPeakSelector(
+                k=streaming_top_k,
+                on_peak=self.deliver_peak if self.album is not None else None,
+            )
+            if streaming_top_k is not None
+            else None
         )
-        if success:
-            rotation_matrix, _ = cv2.Rodrigues(rotation_vector)
-            angles = cv2.decomposeProjectionMatrix(
-                np.hstack((rotation_matrix, np.zeros((3, 1))))
-            )[6]
-            return angles[1], angles[0], angles[2]
-        return 0, 0, 0
+        self.frame_scores = []
+        self.frame_boxes = []
+        self.frame_points = []
+        self.frame_source = None
+        self.eye_ar_threshold = eye_ar_threshold
+        self.score_store = ScoreStore(job_dir) if job_dir is not None else None
+        # 顔ごとの68点ランドマーク（目の開き具合の判定に使う）
+        self.landmark_store = LandmarkStore()
+        if self.score_store is not None:
+            self.landmark_store = self.score_store.landmarks
+            self.load_results()
+
+    def estimate_head_pose(self, shape, frame):
+        return estimate_head_pose(shape, frame.shape)
+
+    def scale_face_boxes(self, frame_no, frame):
+        return self.scale_boxes(self.face_boxes.get(frame_no), frame)
+
+    def scale_boxes(self, boxes, frame):
+        # 解析時の縮小座標を元フレームの座標に戻す
+        if not boxes:
+            return None
+        scale = frame.shape[1] / self.analysis_width
+        return [tuple(int(v * scale) for v in box) for box in boxes]
 
     def calculate_face_score(self, yaw, pitch):
         return max(0, 100 - (abs(yaw) + abs(pitch)))
 
+    def add_face_score(self, frame_no, score):
+        face = FaceInstance(len(self.face_instances))
+        face.frames.append(frame_no)
+        face.scores.append(score)
+        self.face_instances.append(face)
+
+    def collect_face(self, frame_no, box, points, score, source_frame):
+        if self.peak_selector is None:
+            self.add_face_score(frame_no, score)
+            self.face_boxes.setdefault(frame_no, []).append(box)
+        else:
+            self.frame_scores.append(score)
+            self.frame_boxes.append(box)
+            self.frame_points.append(points)
+            self.frame_source = source_frame
+
+    def end_frame(self, frame_no):
+        # ストリーミング時はフレームの平均スコアだけを選択器に渡す
+        if self.peak_selector is not None and self.frame_scores:
+            # ランドマークのバッファは次の解析で上書きされるため、候補として残す分はコピーする
+            self.peak_selector.push(
+                frame_no,
+                np.mean(self.frame_scores),
+                (self.frame_boxes, np.array(self.frame_points), self.frame_source),
+            )
+        self.frame_scores = []
+        self.frame_boxes = []
+        self.frame_points = []
+
+    def record_face(
+        self, frame_no, face, box, points, yaw, pitch, roll, score, source_frame
+    ):
+        self.collect_face(frame_no, box, points, score, source_frame)
+        if self.score_store is not None:
+            self.score_store.append(
+                frame_no, face, box, points, yaw, pitch, roll, score, source_frame
+            )
+        elif self.peak_selector is None:
+            self.landmark_store.append(frame_no, points, source_frame)
+
+    def load_results(self):
+        """チェックポイント済みの解析結果を読み込み、再計算せずに復元する"""
+        # 読み込み中に確定する極大は前回アップロード済みなので配信せず、
+        # アルバムは album.json から復元する
+        on_peak = None
+        if self.album is not None:
+            self.score_store.load_album(self.album)
+            on_peak = self.peak_selector.on_peak
+            self.peak_selector.on_peak = None
+        current_frame = None
+        landmarks = self.score_store.landmarks.records
+        for i, record in enumerate(self.score_store.view()):
+            frame_no = int(record["frame"])
+            if current_frame is not None and frame_no != current_frame:
+                self.end_frame(current_frame)
+            current_frame = frame_no
+            box = (
+                int(record["left"]),
+                int(record["top"]),
+                int(record["right"]),
+                int(record["bottom"]),
+            )
+            self.collect_face(
+                frame_no,
+                box,
+                landmarks["points"][i],
+                float(record["score"]),
+                int(landmarks["source"][i]),
+            )
+        if current_frame is not None:
+            self.end_frame(current_frame)
+        if on_peak is not None:
+            self.peak_selector.on_peak = on_peak
+        if self.score_store.count:
+            print(
+                f"チェックポイントから再開します: {self.score_store.count}件, "
+                f"最終フレーム {self.score_store.last_frame}"
+            )
+
     def calculate_avg_values(self):
         avg_scores = {}
         for face in self.face_instances:
@@ -99,13 +226,19 @@ class FaceProcessor:
         avg_values = [np.mean(avg_scores[frame]) for frame in avg_frames]
         return avg_values, avg_frames
 
-    def plot_face_scores(self):
-        plt.figure()
-        avg_scores = {}
-        for face in self.face_instances:
-            plt.plot(face.frames, face.scores, label=f"Face {face.face_id}")
-            for i, frame in enumerate(face.frames):
-                avg_scores.setdefault(frame, []).append(face.scores[i])
+    def select_peak_frames(self):
+        if self.peak_selector is not None:
+            candidates = self.peak_selector.finish()
+            # 候補フレームの顔領域とランドマークだけを残す
+            self.face_boxes = {}
+            self.landmark_store = LandmarkStore(capacity=64)
+            for frame_no, (boxes, points, source) in sorted(
+                candidates, key=lambda c: c[0]
+            ):
+                self.face_boxes[frame_no] = boxes
+                for face_points in points:
+                    self.landmark_store.append(frame_no, face_points, source)
+            return [frame_no for frame_no, _ in candidates]
 
         avg_values, avg_frames = self.calculate_avg_values()
         avg_values = [v for v in avg_values if isinstance(v, (int, float))]
@@ -127,48 +260,122 @@ class FaceProcessor:
             f: smoothed_avg_values[list(avg_frames).index(f)] for f in peak_frames
         }
         peak_frames = sorted(peak_scores, key=lambda x: peak_scores[x], reverse=True)
-        peak_frames = peak_frames[: int(len(peak_frames) * 0.7)]
+        return peak_frames[: int(len(peak_frames) * 0.7)]
+
+    def read_frame(self, frame_no):
+        if self.frame_reader is None:
+            self.frame_reader = open_decoder(
+                self.decoder_name,
+                self.video_source,
+                width=self.analysis_width,
+                **self.decoder_options,
+            )
+        return self.frame_reader.read(frame_no)
+
+    def upload_frame(self, frame_no, frame, name):
+        ret, image = cv2.imencode(".jpg", frame)
+        if not ret:
+            return False
+        upload_url = f"{UPLOAD_URL}?bucket={self.id}"
+        files = {"file": (name, image.tobytes(), "image/jpeg")}
+        response = requests.post(upload_url, files=files)
+        if response.status_code == 200:
+            print(f"Successfully uploaded frame {frame_no}")
+            return True
+        print(f"Failed to upload frame {frame_no}, status code: {response.status_code}")
+        return False
+
+    def delete_frame(self, name):
+        response = requests.delete(DELETE_URL, params={"bucket": self.id, "name": name})
+        if response.status_code != 200:
+            print(f"Failed to delete {name}, status code: {response.status_code}")
+
+    def deliver_peak(self, frame_no, score, payload):
+        """確定した極大フレームを判定し、アルバムに入るならすぐにアップロードする"""
+        boxes, points, source = payload
+        eye_ratio = eye_aspect_ratios(np.asarray(points)).min()
+        if not eye_ratio >= self.eye_ar_threshold:
+            return
+        # ランドマークを実際に求めたフレームを配信する（同じフレームは既にアルバムにある）
+        frame_no = source
+        if any(entry.frame_no == frame_no for entry in self.album.entries):
+            return
+        frame = self.read_frame(frame_no)
+        if frame is None:
+            return
+        # アルバムに入らないフレームは笑顔判定をしない
+        frame_hash = dhash(frame)
+        evicted = self.album.plan(score, frame_hash)
+        if evicted is None:
+            return
+        if not self.smile_detector.process_single_image2(
+            frame, self.scale_boxes(boxes, frame)
+        ):
+            return
+
+        # 新しい画像を先にアップロードしてから、入れ替わった画像を消す
+        name = f"frame_{frame_no:06d}.jpg"
+        if not self.upload_frame(frame_no, frame, name):
+            return
+        for entry in evicted:
+            self.delete_frame(entry.name)
+            print(f"Frame {entry.frame_no}: Frame {frame_no} に入れ替え")
+        self.album.add(frame_no, score, frame_hash, evicted)
+
+    def ranked_candidates(self):
+        """笑顔判定に回す候補を (フレーム番号, EAR) で目の開いている順に返す"""
+        peak_frames = self.select_peak_frames()
         print("上に凸の頂点となるフレーム番号:", peak_frames)
 
+        # 目の開き具合は保存済みのランドマークから求め、フレームを再デコードしない
         avg_ratios = []
-        for frame_no in peak_frames:
-            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-            ret, frame = self.capture.read()
-            if not ret:
+        eye_ratios = self.landmark_store.min_eye_aspect_ratios(peak_frames)
+        sources = self.landmark_store.source_frames(peak_frames)
+        for frame_no, source, eye_ratio in zip(peak_frames, sources, eye_ratios):
+            print(f"Frame {frame_no}: Minimum Eye Aspect Ratio = {eye_ratio}")
+            # 誰かが目を閉じているフレームは笑顔判定の前に除外する
+            if not eye_ratio >= self.eye_ar_threshold:
+                continue
+            # フレームゲートで間引かれたフレームのランドマークは直前の解析フレームのもの。
+            # 目を閉じた瞬間を通さないよう、候補をランドマークを求めたフレームに移す
+            if any(source == candidate for candidate, _ in avg_ratios):
                 continue
-            avg_ratio = self.calculate_eye_aspect_ratio(frame)
-            avg_ratios.append((frame_no, avg_ratio))
-            print(f"Frame {frame_no}: Average Eye Aspect Ratio = {avg_ratio}")
+            self.face_boxes.setdefault(source, self.face_boxes.get(frame_no))
+            avg_ratios.append((source, eye_ratio))
 
-        avg_ratios = sorted(avg_ratios, key=lambda x: x[1])
-        avg_ratios = avg_ratios[: int(len(avg_ratios) * 0.7)]
+        avg_ratios = sorted(avg_ratios, key=lambda x: x[1], reverse=True)
+        return avg_ratios[: int(len(avg_ratios) * 0.7)]
 
+    def plot_face_scores(self):
+        import matplotlib.pyplot as plt
+
+        plt.figure()
+        for face in self.face_instances:
+            plt.plot(face.frames, face.scores, label=f"Face {face.face_id}")
+
+        avg_ratios = self.ranked_candidates()
+        duplicate_filter = (
+            DuplicateFilter(max_distance=self.dedup_distance)
+            if self.dedup_distance is not None
+            else None
+        )
         for frame_no, _ in avg_ratios:
-            self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-            ret, frame = self.capture.read()
+            frame = self.decoder.read(frame_no)
+            if frame is None:
+                continue
+
+            # 見た目がほぼ同じフレームは、順位が最も高い1枚だけを判定・アップロードする
+            if duplicate_filter is not None and duplicate_filter.is_duplicate(frame):
+                print(f"Frame {frame_no}: 重複フレームのためスキップ")
+                continue
 
             # 笑顔判定
-            if not self.smile_detector.process_single_image2(frame):
+            faces = self.scale_face_boxes(frame_no, frame)
+            if not self.smile_detector.process_single_image2(frame, faces):
                 continue
 
-            if ret:
-                # 画像を保存する
-                temp_file = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-                frame_filename = temp_file.name
-                temp_file.close()
-                cv2.imwrite(frame_filename, frame)
-
-                # 画像をアップロード
-                upload_url = f"https://app-122ab23f-3126-4106-9d44-988a8bd962de.ingress.apprun.sakura.ne.jp/upload?bucket={self.id}"
-                files = {"file": open(frame_filename, "rb")}
-                response = requests.post(upload_url, files=files)
-                if response.status_code == 200:
-                    print(f"Successfully uploaded frame {frame_no}")
-                else:
-                    print(
-                        f"Failed to upload frame {frame_no}, status code: {response.status_code}"
-                    )
-                files["file"].close()
+            # 画像をアップロード
+            self.upload_frame(frame_no, frame, f"frame_{frame_no:06d}.jpg")
 
         # plt.plot(
         #     avg_frames[:len(smoothed_avg_values)],  # xとyの次元を一致させる
@@ -180,94 +387,88 @@ class FaceProcessor:
         # plt.legend()
         # plt.show()
 
-    def process_video(self):
-        while True:
-            ret, frame = self.capture.read()
-            if not ret:
-                print("動画の読み込み終了またはエラー発生")
-                break
-
-            frame = imutils.resize(frame, width=1000)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            rects = self.detector(gray, 0)
+    def analyze(self):
+        """チェックポイントがあれば続きから、全フレームを解析する"""
+        start = 0
+        if self.score_store is not None:
+            start = self.score_store.last_frame + 1
+        if self.score_store is None or not self.score_store.complete:
+            self.analyze_frames(start)
 
-            model_points = np.array(
-                [
-                    (0.0, 0.0, 0.0),
-                    (-30.0, -125.0, -30.0),
-                    (30.0, -125.0, -30.0),
-                    (-60.0, -70.0, -60.0),
-                    (60.0, -70.0, -60.0),
-                    (-40.0, 40.0, -50.0),
-                    (40.0, 40.0, -50.0),
-                ]
-            )
-            size = frame.shape
-            focal_length = size[1]
-            center = (size[1] // 2, size[0] // 2)
-            camera_matrix = np.array(
-                [[focal_length, 0, center[0]], [0, focal_length, center[1]], [0, 0, 1]],
-                dtype="double",
-            )
-            dist_coeffs = np.zeros((4, 1))
-
-            for rect in rects:
-                shape = self.predictor(gray, rect)
-                shape = face_utils.shape_to_np(shape)
-                image_points = np.array(
-                    [
-                        tuple(shape[30]),
-                        tuple(shape[21]),
-                        tuple(shape[22]),
-                        tuple(shape[39]),
-                        tuple(shape[42]),
-                        tuple(shape[31]),
-                        tuple(shape[35]),
-                    ],
-                    dtype="double",
-                )
-                shape = self.predictor(gray, rect)
-                shape = face_utils.shape_to_np(shape)
-                yaw, pitch, roll = self.estimate_head_pose(shape, frame)
-                face_id = len(self.face_instances)
-                face = FaceInstance(face_id)
-                face.frames.append(self.capture.get(cv2.CAP_PROP_POS_FRAMES))
-                face.scores.append(self.calculate_face_score(yaw, pitch))
-                self.face_instances.append(face)
-
-                for x, y in shape:
-                    cv2.circle(frame, (x, y), 1, (255, 255, 255), -1)
-
-                success, rotation_vector, translation_vector = cv2.solvePnP(
-                    model_points,
-                    image_points,
-                    camera_matrix,
-                    dist_coeffs,
-                    flags=cv2.SOLVEPNP_ITERATIVE,
-                )
-
-                nose_end_point2D, _ = cv2.projectPoints(
-                    np.array([(0.0, 0.0, 500.0)]),
-                    rotation_vector,
-                    translation_vector,
-                    camera_matrix,
-                    dist_coeffs,
-                )
+    def close(self):
+        self.decoder.close()
+        if self.frame_reader is not None:
+            self.frame_reader.close()
 
-                p1 = (int(image_points[0][0]), int(image_points[0][1]))
-                p2 = (
-                    int(nose_end_point2D[0][0][0]),
-                    int(nose_end_point2D[0][0][1]),
+    def process_video(self):
+        self.analyze()
+        if self.album is not None:
+            # 末尾の極大フレームを確定させる（それ以前のものは解析中に配信済み）
+            self.peak_selector.finish()
+            print(
+                "アルバムのフレーム番号:",
+                sorted(e.frame_no for e in self.album.entries),
+            )
+        else:
+            self.plot_face_scores()
+        self.close()
+
+    def analyze_frame(self, frame_no, gray):
+        if self.frame_gate is not None and not self.frame_gate.should_analyze(gray):
+            # 変化の小さいフレームは前回解析したフレームの結果を再利用する
+            for face, result in enumerate(self.last_results):
+                self.record_face(frame_no, face, *result)
+        else:
+            rects = self.detector(gray, 0)
+            if len(rects) > len(self.landmarks):
+                self.landmarks = np.empty((len(rects), 68, 2), dtype=np.int32)
+            shapes = self.landmarks[: len(rects)]
+            for face, rect in enumerate(rects):
+                fill_landmarks(self.predictor(gray, rect), shapes[face])
+            # フレーム内の顔の姿勢をまとめて推定する
+            yaws, pitches, rolls = self.pose_engine.estimate(shapes, gray.shape)
+            self.last_results = []
+            for face, rect in enumerate(rects):
+                box = (rect.left(), rect.top(), rect.right(), rect.bottom())
+                yaw, pitch = float(yaws[face]), float(pitches[face])
+                result = (
+                    box,
+                    shapes[face],
+                    yaw,
+                    pitch,
+                    float(rolls[face]),
+                    float(self.calculate_face_score(yaw, pitch)),
+                    frame_no,
                 )
-
-                cv2.arrowedLine(frame, p1, p2, (255, 0, 0), 2)
-
-            print(f"Frame {self.capture.get(cv2.CAP_PROP_POS_FRAMES)}")
-            # cv2.imshow("Processed Image", frame)
-            # if cv2.waitKey(1) & 0xFF == ord("q"):
-            #     break
-
-        self.plot_face_scores()
+                self.record_face(frame_no, face, *result)
+                self.last_results.append(result)
+
+        self.end_frame(frame_no)
+        if self.score_store is not None:
+            self.score_store.end_frame(frame_no)
+        if self.profiler is not None:
+            # このフレームで確保したオブジェクトが残っているうちに計測する
+            self.profiler.tick()
+
+    def analyze_frames(self, start=0):
+        if self.profiler is not None:
+            self.profiler.start()
+        for decoded in self.decoder.frames(start):
+            if self.profiler is not None:
+                self.profiler.begin_frame()
+            self.analyze_frame(decoded.index, decoded.gray)
+            print(f"Frame {decoded.index} ({decoded.timestamp:.2f}s)")
+
+        if self.profiler is not None:
+            self.profiler.stop()
+        print("動画の読み込み終了")
+        if self.frame_gate is not None:
+            print(
+                f"解析フレーム数: {self.frame_gate.analyzed}, "
+                f"スキップフレーム数: {self.frame_gate.skipped}"
+            )
+        if self.score_store is not None:
+            self.score_store.checkpoint(complete=True)
 
 
 if __name__ == "__main__":
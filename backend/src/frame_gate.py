@@ -0,0 +1,40 @@
+import cv2
+
+
+class FrameGate:
+    """直前に解析したフレームとの差分が小さいフレームの解析をスキップする"""
+
+    def __init__(self, threshold=2.0, size=(64, 36), max_skip=15):
+        self.threshold = threshold
+        self.size = size
+        self.max_skip = max_skip
+        self.reference = None
+        # 縮小画像と差分のバッファ（解析したフレームの縮小画像は reference と入れ替える）
+        self.small = None
+        self.diff = None
+        self.consecutive_skips = 0
+        self.analyzed = 0
+        self.skipped = 0
+
+    def should_analyze(self, frame):
+        if frame.ndim == 3:
+            small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.small)
+        else:
+            small = cv2.resize(
+                frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA
+            )
+
+        # 少しずつの変化が蓄積しないよう、比較対象は最後に解析したフレームとする
+        if self.reference is not None and self.consecutive_skips < self.max_skip:
+            self.diff = cv2.absdiff(small, self.reference, dst=self.diff)
+            if self.diff.mean() < self.threshold:
+                self.small = small
+                self.consecutive_skips += 1
+                self.skipped += 1
+                return False
+
+        self.small, self.reference = self.reference, small
+        self.consecutive_skips = 0
+        self.analyzed += 1
+        return True
@@ -0,0 +1,369 @@
+"""アップロードから画像保存までの経路をローカルで負荷試験する
+
+サーバーをローカルで起動し、画像の保存先 (s3/main.go) はスタブに置き換える。
+合成動画を指定した到着率（ポアソン到着）で送り、ジョブの完了までを計測する。
+--face-image で顔写真を合成すると、ランドマーク・姿勢推定・目の開き判定・笑顔判定・
+JPEGエンコード・アップロードまで含めて計測できる（笑顔の写真を使うこと）。
+
+    uv run src/loadtest.py --rate 0.5 --jobs 20 --face-image smile.jpg
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import cv2
+import numpy as np
+from aiohttp import web
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_mix(value):
+    """'1280x720:10:3,1920x1080:5:1' を (幅, 高さ, 秒数, 重み) のリストにする"""
+    mix = []
+    for item in value.split(","):
+        size, seconds, weight = item.split(":")
+        width, height = size.split("x")
+        mix.append((int(width), int(height), float(seconds), float(weight)))
+    return mix
+
+
+def write_synthetic_video(path, width, height, seconds, fps=30, seed=0, face=None):
+    """動く図形の合成動画を書き出す（フレームゲートで全て間引かれないように毎フレーム変化させる）
+
+    face を渡すと、図形の代わりにその顔画像を画面の中央付近でゆっくり動かす。
+    """
+    rng = np.random.default_rng(seed)
+    if face is not None:
+        # 縦横とも画面の半分に収まるように縮小する
+        scale = min(height / 2 / face.shape[0], width / 2 / face.shape[1])
+        face = cv2.resize(
+            face, (int(face.shape[1] * scale), int(face.shape[0] * scale))
+        )
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height)
+    )
+    background = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    background = cv2.resize(background, (width, height))
+    for i in range(int(seconds * fps)):
+        frame = background.copy()
+        if face is None:
+            x = int((width / 2) * (1 + np.sin(i / fps)))
+            y = int((height / 2) * (1 + np.cos(i / fps)))
+            cv2.circle(frame, (x, y), height // 6, (220, 200, 180), -1)
+        else:
+            face_height, face_width = face.shape[:2]
+            x = int((width - face_width) / 2 * (1 + 0.5 * np.sin(i / fps)))
+            y = int((height - face_height) / 2 * (1 + 0.2 * np.cos(i / fps)))
+            frame[y : y + face_height, x : x + face_width] = face
+        writer.write(frame)
+    writer.release()
+
+
+def prepare_videos(args, work_dir):
+    face = None
+    if args.face_image is not None:
+        face = cv2.imread(args.face_image)
+        if face is None:
+            raise SystemExit(f"顔画像を読み込めません: {args.face_image}")
+    videos = []
+    for i, (width, height, seconds, weight) in enumerate(parse_mix(args.mix)):
+        path = os.path.join(work_dir, f"synthetic_{width}x{height}_{seconds:g}s.mp4")
+        write_synthetic_video(path, width, height, seconds, seed=i, face=face)
+        videos.append((path, weight))
+    # 顔の写った実際の動画を混ぜると、笑顔判定とアップロードまで計測できる
+    for path in args.video:
+        videos.append((path, 1.0))
+    return videos
+
+
+class UploadStub:
+    """s3/main.go の /upload の代わりに画像を受け取り、件数だけ数える"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.uploads = 0
+        self.bytes = 0
+        self.app = web.Application()
+        self.deletes = 0
+        self.app.router.add_post("/upload", self.upload)
+        self.app.router.add_delete("/images", self.delete)
+
+    async def upload(self, request):
+        data = await request.post()
+        self.bytes += len(data["file"].file.read())
+        self.uploads += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"message": "File uploaded successfully"})
+
+    async def delete(self, request):
+        self.deletes += 1
+        return web.json_response({"message": "Delete successful"})
+
+    async def start(self, port):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def start_server(args, jobs_dir):
+    # ジョブの状態はプロセス内で持つため、uvicornのワーカーは1つで起動する
+    env = dict(
+        os.environ,
+        UPLOAD_URL=f"http://127.0.0.1:{args.stub_port}/upload",
+        JOBS_DIR=jobs_dir,
+    )
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "server:app",
+            "--app-dir",
+            "src",
+            "--port",
+            str(args.port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+
+
+async def wait_ready(session, url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/ready") as response:
+                if response.status == 200:
+                    return await response.json()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(1)
+    raise TimeoutError(f"サーバーが{timeout}秒以内に準備完了になりませんでした")
+
+
+def process_tree(pid):
+    """pid とその子孫のプロセスIDを返す"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+async def sample_rss(pid, samples, interval=1.0):
+    while True:
+        for child in process_tree(pid):
+            rss = rss_mb(child)
+            if rss is not None:
+                samples.setdefault(child, []).append(rss)
+        await asyncio.sleep(interval)
+
+
+async def run_job(session, url, path, decoder, timeout, poll_interval):
+    result = {"video": os.path.basename(path), "submitted": time.time()}
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        form = aiohttp.FormData()
+        form.add_field(
+            "file",
+            content,
+            filename=os.path.basename(path),
+            content_type="video/mp4",
+        )
+        async with session.post(
+            f"{url}/upload", data=form, params={"decoder": decoder}
+        ) as response:
+            if response.status != 200:
+                result["error"] = f"upload: HTTP {response.status}"
+                return result
+            process_id = (await response.json())["process_id"]
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(poll_interval)
+            async with session.get(f"{url}/jobs/{process_id}") as response:
+                status = await response.json()
+            if status.get("status") in ("done", "error"):
+                result.update(status)
+                result["completed"] = time.time()
+                if status["status"] == "error":
+                    result["error"] = status.get("error", "error")
+                return result
+        result["error"] = "timeout"
+    except aiohttp.ClientError as e:
+        result["error"] = str(e)
+    return result
+
+
+async def replay(args, url, videos, server_pid):
+    paths = [path for path, _ in videos]
+    weights = [weight for _, weight in videos]
+    rng = random.Random(args.seed)
+    rss_samples = {}
+
+    async with aiohttp.ClientSession() as session:
+        warmup = await wait_ready(session, url, args.ready_timeout)
+        print(f"ウォームアップ時間: {warmup['warmup_time']}秒")
+
+        sampler = None
+        if server_pid is not None:
+            sampler = asyncio.create_task(sample_rss(server_pid, rss_samples))
+
+        start = time.time()
+        tasks = []
+        for _ in range(args.jobs):
+            path = rng.choices(paths, weights)[0]
+            tasks.append(
+                asyncio.create_task(
+                    run_job(
+                        session,
+                        url,
+                        path,
+                        args.decoder,
+                        args.job_timeout,
+                        args.poll_interval,
+                    )
+                )
+            )
+            # ポアソン到着: 到着間隔は指数分布に従う
+            await asyncio.sleep(rng.expovariate(args.rate))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.time() - start
+
+        if sampler is not None:
+            sampler.cancel()
+    return results, elapsed, rss_samples
+
+
+def percentiles(name, values):
+    if not values:
+        print(f"{name}: データなし")
+        return
+    values = np.array(values)
+    print(
+        f"{name}: n={len(values)}, mean={values.mean():.2f}s, "
+        f"p50={np.percentile(values, 50):.2f}s, "
+        f"p95={np.percentile(values, 95):.2f}s, "
+        f"p99={np.percentile(values, 99):.2f}s"
+    )
+
+
+def report(results, elapsed, rss_samples, stub):
+    completed = [r for r in results if "error" not in r]
+    errors = [r for r in results if "error" in r]
+
+    percentiles(
+        "エンドツーエンド", [r["completed"] - r["submitted"] for r in completed]
+    )
+    percentiles("待ち時間", [r["started_at"] - r["queued_at"] for r in completed])
+    percentiles("処理時間", [r["finished_at"] - r["started_at"] for r in completed])
+    print(
+        f"スループット: {len(completed) / elapsed * 60:.2f}ジョブ/分 "
+        f"({len(completed)}件 / {elapsed:.1f}秒)"
+    )
+    print(f"エラー率: {len(errors) / len(results):.1%} ({len(errors)}件)")
+    for r in errors[:5]:
+        print(f"  {r['video']}: {r['error']}")
+    print(
+        f"アップロードされた画像: {stub.uploads}枚, {stub.bytes / 1e6:.1f}MB, "
+        f"削除: {stub.deletes}枚"
+    )
+    for pid, samples in sorted(rss_samples.items()):
+        print(f"RSS pid={pid}: mean={np.mean(samples):.0f}MB, max={max(samples):.0f}MB")
+
+
+async def main_async(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        videos = prepare_videos(args, work_dir)
+        stub = UploadStub(latency=args.upload_latency)
+        await stub.start(args.stub_port)
+
+        server = None
+        server_pid = args.server_pid
+        url = args.url
+        if url is None:
+            server = start_server(args, os.path.join(work_dir, "jobs"))
+            server_pid = server.pid
+            url = f"http://127.0.0.1:{args.port}"
+        try:
+            results, elapsed, rss_samples = await replay(args, url, videos, server_pid)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            await stub.stop()
+        report(results, elapsed, rss_samples, stub)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=0.2, help="到着率 (ジョブ/秒)")
+    parser.add_argument("--jobs", type=int, default=20, help="送信するジョブ数")
+    parser.add_argument(
+        "--mix",
+        default="1280x720:10:3,1920x1080:5:1",
+        help="合成動画の構成 (幅x高さ:秒数:重み をカンマ区切り)",
+    )
+    parser.add_argument(
+        "--face-image", help="合成動画に写す顔画像（指定しないと顔のない動画になる）"
+    )
+    parser.add_argument("--video", action="append", default=[], help="混ぜる実際の動画")
+    parser.add_argument("--decoder", default="opencv", choices=["opencv", "pyav"])
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--stub-port", type=int, default=5101)
+    parser.add_argument(
+        "--upload-latency", type=float, default=0.0, help="スタブの応答遅延 (秒)"
+    )
+    parser.add_argument(
+        "--url",
+        help="起動済みのサーバーのURL（UPLOAD_URLはスタブに向けておくこと）",
+    )
+    parser.add_argument(
+        "--server-pid", type=int, help="起動済みのサーバーのpid (RSS計測用)"
+    )
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    parser.add_argument("--job-timeout", type=float, default=1800)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
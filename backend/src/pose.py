@@ -0,0 +1,159 @@
+import cv2
+import numpy as np
+
+# 顔の3Dモデル上の基準点と、対応する68点ランドマークの番号
+MODEL_POINTS = np.array(
+    [
+        (0.0, 0.0, 0.0),
+        (-30.0, -125.0, -30.0),
+        (30.0, -125.0, -30.0),
+        (-60.0, -70.0, -60.0),
+        (60.0, -70.0, -60.0),
+        (-40.0, 40.0, -50.0),
+        (40.0, 40.0, -50.0),
+    ]
+)
+LANDMARK_INDICES = [30, 21, 22, 39, 42, 31, 35]
+
+
+def camera_intrinsics(size):
+    focal_length = size[1]
+    center = (size[1] // 2, size[0] // 2)
+    camera_matrix = np.array(
+        [[focal_length, 0, center[0]], [0, focal_length, center[1]], [0, 0, 1]],
+        dtype="double",
+    )
+    return camera_matrix, np.zeros((4, 1))
+
+
+def estimate_head_pose(shape, size):
+    """1つの顔について毎回solvePnPを解き、(yaw, pitch, roll) を返す"""
+    camera_matrix, dist_coeffs = camera_intrinsics(size)
+    image_points = shape[LANDMARK_INDICES].astype("double")
+    success, rotation_vector, translation_vector = cv2.solvePnP(
+        MODEL_POINTS,
+        image_points,
+        camera_matrix,
+        dist_coeffs,
+        flags=cv2.SOLVEPNP_ITERATIVE,
+    )
+    if success:
+        rotation_matrix, _ = cv2.Rodrigues(rotation_vector)
+        angles = cv2.decomposeProjectionMatrix(
+            np.hstack((rotation_matrix, np.zeros((3, 1))))
+        )[6]
+        return angles[1], angles[0], angles[2]
+    return 0, 0, 0
+
+
+def rotation_matrices(rotation_vectors):
+    """回転ベクトル (N, 3) をまとめて回転行列 (N, 3, 3) に変換する (Rodriguesの公式)"""
+    theta = np.linalg.norm(rotation_vectors, axis=1)
+    axis = rotation_vectors / np.where(theta > 0, theta, 1)[:, np.newaxis]
+    x, y, z = axis.T
+    zeros = np.zeros_like(x)
+    k = np.stack(
+        [
+            np.stack([zeros, -z, y], axis=1),
+            np.stack([z, zeros, -x], axis=1),
+            np.stack([-y, x, zeros], axis=1),
+        ],
+        axis=1,
+    )
+    sin = np.sin(theta)[:, np.newaxis, np.newaxis]
+    cos = np.cos(theta)[:, np.newaxis, np.newaxis]
+    return np.eye(3) + sin * k + (1 - cos) * (k @ k)
+
+
+def euler_angles(rotations):
+    """回転行列 (N, 3, 3) から decomposeProjectionMatrix と同じオイラー角を求める
+
+    R = Rz(roll) @ Ry(yaw) @ Rx(pitch) として閉形式で分解する。
+    """
+    pitch = np.arctan2(rotations[:, 2, 1], rotations[:, 2, 2])
+    yaw = np.arctan2(
+        -rotations[:, 2, 0], np.hypot(rotations[:, 2, 1], rotations[:, 2, 2])
+    )
+    roll = np.arctan2(rotations[:, 1, 0], rotations[:, 0, 0])
+    return np.degrees(yaw), np.degrees(pitch), np.degrees(roll)
+
+
+class PoseEngine:
+    """前フレームの同じ顔の姿勢を初期値にしてsolvePnPを解き、フレーム内の顔をまとめて角度に変換する
+
+    追跡できなかった顔だけ初期値なしで解き直す。
+    """
+
+    def __init__(self, max_track_distance=40.0):
+        self.max_track_distance = max_track_distance
+        self.intrinsics = {}
+        self.tracks = []
+
+    def camera(self, size):
+        key = size[:2]
+        if key not in self.intrinsics:
+            self.intrinsics[key] = camera_intrinsics(key)
+        return self.intrinsics[key]
+
+    def match_track(self, nose, used):
+        best, best_distance = None, self.max_track_distance
+        for i, (track_nose, _, _) in enumerate(self.tracks):
+            distance = np.linalg.norm(nose - track_nose)
+            if i not in used and distance < best_distance:
+                best, best_distance = i, distance
+        return best
+
+    def solve(self, image_points, camera_matrix, dist_coeffs, guess=None):
+        if guess is not None:
+            success, rotation_vector, translation_vector = cv2.solvePnP(
+                MODEL_POINTS,
+                image_points,
+                camera_matrix,
+                dist_coeffs,
+                guess[0].copy(),
+                guess[1].copy(),
+                useExtrinsicGuess=True,
+                flags=cv2.SOLVEPNP_ITERATIVE,
+            )
+            # 顔がカメラの後ろに来るような解は追跡失敗とみなす
+            if success and translation_vector[2, 0] > 0:
+                return rotation_vector, translation_vector
+        success, rotation_vector, translation_vector = cv2.solvePnP(
+            MODEL_POINTS,
+            image_points,
+            camera_matrix,
+            dist_coeffs,
+            flags=cv2.SOLVEPNP_ITERATIVE,
+        )
+        return (rotation_vector, translation_vector) if success else None
+
+    def estimate(self, shapes, size):
+        """フレーム内の全ての顔の (yaw, pitch, roll) を配列で返す。失敗した顔は0
+
+        shapes は (N, 68, 2) の配列か、(68, 2) の配列のリスト。
+        """
+        camera_matrix, dist_coeffs = self.camera(size)
+        # 顔ごとではなくフレーム単位で基準点を取り出す
+        shapes = np.asarray(shapes).reshape(len(shapes), 68, 2)
+        all_image_points = shapes[:, LANDMARK_INDICES].astype(np.float64, order="C")
+        rotation_vectors = np.zeros((len(shapes), 3))
+        solved = np.zeros(len(shapes), dtype=bool)
+        tracks, used = [], set()
+        for i, image_points in enumerate(all_image_points):
+            nose = image_points[0]
+            track = self.match_track(nose, used)
+            guess = None
+            if track is not None:
+                used.add(track)
+                guess = self.tracks[track][1:]
+            result = self.solve(image_points, camera_matrix, dist_coeffs, guess)
+            if result is None:
+                continue
+            rotation_vectors[i] = result[0].ravel()
+            solved[i] = True
+            tracks.append((nose, *result))
+        self.tracks = tracks
+
+        yaw, pitch, roll = euler_angles(rotation_matrices(rotation_vectors))
+        yaw[~solved] = pitch[~solved] = roll[~solved] = 0
+        return yaw, pitch, roll
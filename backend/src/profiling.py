@@ -0,0 +1,100 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class FrameProfiler:
+    """tracemallocでフレームループのメモリ確保と1フレームあたりの処理時間を計測する
+
+    tick() はデコードも含めて前回の tick() からの区間を1フレームとして記録する。
+    numpy・OpenCVの配列もtracemallocで追跡されるため、一時バッファの確保量が分かる。
+    sample_interval フレームごとに begin_frame() と tick() の間でスナップショットを比較し、
+    そのフレームで確保されて tick() の時点で残っているブロック数を数える。
+    """
+
+    def __init__(self, top=10, sample_interval=10):
+        self.top = top
+        self.sample_interval = sample_interval
+        self.frames = 0
+        self.latencies = []
+        self.peak_bytes = []
+        self.blocks = []
+        self.frame_snapshot = None
+        self.first_snapshot = None
+        self.last_snapshot = None
+
+    def take_snapshot(self):
+        # tracemallocとこのモジュール自身の確保は除く
+        return tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ]
+        )
+
+    def start(self):
+        tracemalloc.start()
+        self.first_snapshot = self.take_snapshot()
+        self.mark()
+
+    def mark(self):
+        tracemalloc.reset_peak()
+        self.base_bytes = tracemalloc.get_traced_memory()[0]
+        self.started = time.perf_counter()
+
+    def begin_frame(self):
+        if self.frames % self.sample_interval == 0:
+            self.frame_snapshot = self.take_snapshot()
+
+    def tick(self):
+        self.frames += 1
+        if self.frame_snapshot is not None:
+            stats = self.take_snapshot().compare_to(self.frame_snapshot, "traceback")
+            self.blocks.append(sum(max(stat.count_diff, 0) for stat in stats))
+            self.frame_snapshot = None
+            # スナップショットの時間と確保量は処理時間・確保量に含めない
+            self.mark()
+            return
+        self.latencies.append(time.perf_counter() - self.started)
+        # 区間内で一時的に確保されたメモリの最大量
+        self.peak_bytes.append(tracemalloc.get_traced_memory()[1] - self.base_bytes)
+        self.mark()
+
+    def stop(self):
+        self.last_snapshot = self.take_snapshot()
+        tracemalloc.stop()
+
+    def report(self):
+        if not self.latencies:
+            print("計測したフレームがありません")
+            return
+        latencies = np.array(self.latencies) * 1000
+        peak_bytes = np.array(self.peak_bytes) / 1024
+        print(
+            f"フレーム数: {self.frames}, "
+            f"処理時間 mean={latencies.mean():.2f}ms, "
+            f"p50={np.percentile(latencies, 50):.2f}ms, "
+            f"p95={np.percentile(latencies, 95):.2f}ms"
+        )
+        print(
+            f"フレームあたりの一時確保量 mean={peak_bytes.mean():.1f}KiB, "
+            f"max={peak_bytes.max():.1f}KiB"
+        )
+        if self.blocks:
+            blocks = np.array(self.blocks)
+            print(
+                f"フレームあたりの確保ブロック数 ({len(blocks)}フレームを抽出) "
+                f"mean={blocks.mean():.1f}, p95={np.percentile(blocks, 95):.1f}"
+            )
+        if self.last_snapshot is None:
+            return
+        # ループ後も残っている確保を行数ごとに集計する
+        stats = self.last_snapshot.compare_to(self.first_snapshot, "lineno")
+        print(f"ループ後も残っているメモリ確保 (上位{self.top}件):")
+        for stat in stats[: self.top]:
+            frame = stat.traceback[0]
+            print(
+                f"  {frame.filename}:{frame.lineno}: "
+                f"{stat.count_diff:+d}ブロック, {stat.size_diff / 1024:+.1f}KiB"
+            )
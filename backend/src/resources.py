@@ -0,0 +1,70 @@
+import os
+import sys
+
+# importより前に設定しないと効かないスレッド数の環境変数
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ResourceProfile:
+    """ノードのCPUコアを同時実行ジョブで分け合い、ライブラリごとのスレッド数を決める
+
+    OpenCV・PyTorch・ONNX Runtimeのスレッドプールはプロセス全体で共有されるため、
+    それぞれジョブ1つあたりのコア数に制限して過剰なスレッド生成を防ぐ。
+    """
+
+    def __init__(self, concurrent_jobs=1, cores=None):
+        self.cores = cores or available_cores()
+        self.concurrent_jobs = max(1, concurrent_jobs)
+        self.threads_per_job = max(1, self.cores // self.concurrent_jobs)
+
+    @classmethod
+    def from_env(cls):
+        cores = os.getenv("CPU_CORES")
+        return cls(
+            concurrent_jobs=int(os.getenv("JOB_CONCURRENCY", "1")),
+            cores=int(cores) if cores else None,
+        )
+
+    def set_env(self):
+        """numpy・torchなどをimportする前に呼ぶ"""
+        for name in THREAD_ENV_VARS:
+            os.environ.setdefault(name, str(self.threads_per_job))
+
+    def apply(self):
+        """読み込み済みのライブラリのスレッド数を設定する"""
+        import cv2
+
+        cv2.setNumThreads(self.threads_per_job)
+        if "torch" in sys.modules:
+            import torch
+
+            torch.set_num_threads(self.threads_per_job)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # 並列処理が一度でも走った後は変更できない
+                pass
+
+    def session_options(self):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads_per_job
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        return options
+
+    def decoder_options(self):
+        return {"threads": self.threads_per_job}
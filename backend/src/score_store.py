@@ -0,0 +1,190 @@
+import json
+import os
+
+import numpy as np
+
+# 1顔・1フレームあたりの解析結果（固定長レコード）
+RECORD_DTYPE = np.dtype(
+    [
+        ("frame", "<i4"),
+        ("face", "<i2"),
+        ("left", "<i2"),
+        ("top", "<i2"),
+        ("right", "<i2"),
+        ("bottom", "<i2"),
+        ("yaw", "<f4"),
+        ("pitch", "<f4"),
+        ("roll", "<f4"),
+        ("score", "<f4"),
+    ]
+)
+
+# 1顔・1フレームあたりの68点ランドマーク（スコアのレコードと同じ順序で並ぶ）
+# source はランドマークを実際に求めたフレーム。フレームゲートで間引かれたフレームでは
+# 直前に解析したフレームの結果を使い回すため、frame と異なる
+LANDMARK_DTYPE = np.dtype(
+    [("frame", "<i4"), ("source", "<i4"), ("points", "<i2", (68, 2))]
+)
+
+
+def open_records(path, dtype, capacity):
+    size = capacity * dtype.itemsize
+    with open(path, "ab") as f:
+        if f.tell() < size:
+            f.truncate(size)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=(capacity,))
+
+
+def eye_aspect_ratios(points):
+    """ランドマーク (N, 68, 2) から両目のEye Aspect Ratioの平均 (N,) をまとめて求める"""
+    points = points.astype(np.float32)
+    ratios = []
+    for eye in (points[:, 36:42], points[:, 42:48]):
+        a = np.linalg.norm(eye[:, 1] - eye[:, 5], axis=1)
+        b = np.linalg.norm(eye[:, 2] - eye[:, 4], axis=1)
+        c = np.linalg.norm(eye[:, 0] - eye[:, 3], axis=1)
+        ratios.append((a + b) / (2.0 * np.maximum(c, 1e-6)))
+    return (ratios[0] + ratios[1]) / 2
+
+
+class LandmarkStore:
+    """顔ごとのランドマークをint16の配列に追記し、フレーム番号で引けるようにする
+
+    path を指定するとメモリマップファイルに保存する。フレーム番号は昇順に追記すること。
+    """
+
+    def __init__(self, path=None, count=0, capacity=4096):
+        self.path = path
+        self.count = count
+        self.records = None
+        self.records = self._open(max(capacity, count))
+
+    def _open(self, capacity):
+        if self.path is not None:
+            return open_records(self.path, LANDMARK_DTYPE, capacity)
+        records = np.zeros(capacity, dtype=LANDMARK_DTYPE)
+        if self.records is not None:
+            records[: self.count] = self.records[: self.count]
+        return records
+
+    def append(self, frame_no, points, source_frame=None):
+        if self.count == len(self.records):
+            self.flush()
+            self.records = self._open(len(self.records) * 2)
+        if source_frame is None:
+            source_frame = frame_no
+        self.records[self.count] = (frame_no, source_frame, points)
+        self.count += 1
+
+    def flush(self):
+        if self.path is not None:
+            self.records.flush()
+
+    def frame_points(self, frame_no):
+        frames = self.records["frame"][: self.count]
+        start, end = np.searchsorted(frames, [frame_no, frame_no + 1])
+        return self.records["points"][start:end]
+
+    def source_frames(self, frame_nos):
+        """各フレームのランドマークを求めたフレーム番号を返す（顔がなければそのまま）"""
+        frames = self.records["frame"][: self.count]
+        starts = np.searchsorted(frames, frame_nos)
+        ends = np.searchsorted(frames, np.asarray(frame_nos) + 1)
+        return [
+            int(self.records["source"][start]) if end > start else int(frame_no)
+            for frame_no, start, end in zip(frame_nos, starts, ends)
+        ]
+
+    def min_eye_aspect_ratios(self, frame_nos):
+        """各フレームで最も目が閉じている顔のEARを返す（顔がなければNaN）"""
+        frames = self.records["frame"][: self.count]
+        starts = np.searchsorted(frames, frame_nos)
+        ends = np.searchsorted(frames, np.asarray(frame_nos) + 1)
+        return np.array(
+            [
+                eye_aspect_ratios(self.records["points"][start:end]).min()
+                if end > start
+                else np.nan
+                for start, end in zip(starts, ends)
+            ]
+        )
+
+
+class ScoreStore:
+    """ジョブディレクトリのメモリマップファイルに解析結果を追記し、定期的にチェックポイントを取る
+
+    ランドマークも landmarks.bin に同じ順序で保存する。
+    アルバムを渡すと、チェックポイントのたびにその時点のエントリを album.json に保存する。
+    チェックポイント以降に書かれたレコードは再開時に上書きされる。
+    """
+
+    def __init__(self, job_dir, checkpoint_interval=100, capacity=4096):
+        os.makedirs(job_dir, exist_ok=True)
+        self.path = os.path.join(job_dir, "scores.bin")
+        self.checkpoint_path = os.path.join(job_dir, "checkpoint.json")
+        self.album_path = os.path.join(job_dir, "album.json")
+        self.checkpoint_interval = checkpoint_interval
+        self.album = None
+
+        checkpoint = {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        self.count = checkpoint.get("count", 0)
+        self.last_frame = checkpoint.get("last_frame", -1)
+        self.complete = checkpoint.get("complete", False)
+        self.frames_since_checkpoint = 0
+        self.records = open_records(self.path, RECORD_DTYPE, max(capacity, self.count))
+        self.landmarks = LandmarkStore(
+            os.path.join(job_dir, "landmarks.bin"), self.count, capacity
+        )
+
+    def load_album(self, album):
+        """アルバムをチェックポイントの対象にし、保存済みのエントリを復元する"""
+        self.album = album
+        if self.count and os.path.exists(self.album_path):
+            with open(self.album_path) as f:
+                album.restore(json.load(f))
+
+    def write_json(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def append(
+        self, frame_no, face, box, points, yaw, pitch, roll, score, source_frame=None
+    ):
+        if self.count == len(self.records):
+            # 容量が足りなくなったらファイルを倍に拡張して開き直す
+            self.records.flush()
+            self.records = open_records(self.path, RECORD_DTYPE, len(self.records) * 2)
+        self.records[self.count] = (frame_no, face, *box, yaw, pitch, roll, score)
+        self.landmarks.append(frame_no, points, source_frame)
+        self.count += 1
+
+    def end_frame(self, frame_no):
+        self.last_frame = frame_no
+        self.frames_since_checkpoint += 1
+        if self.frames_since_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self, complete=False):
+        self.records.flush()
+        self.landmarks.flush()
+        self.complete = complete
+        # アルバムはチェックポイントより先に書き、再開時にレコードと食い違わないようにする
+        if self.album is not None:
+            self.write_json(self.album_path, self.album.state())
+        self.write_json(
+            self.checkpoint_path,
+            {
+                "count": self.count,
+                "last_frame": self.last_frame,
+                "complete": complete,
+            },
+        )
+        self.frames_since_checkpoint = 0
+
+    def view(self):
+        return self.records[: self.count]
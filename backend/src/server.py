@@ -1,15 +1,20 @@
+import importlib
+import json
 import logging
 import os
-from tempfile import NamedTemporaryFile
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import uvicorn
-from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from ulid import ULID
 
-from face_processor import FaceProcessor
 from line import router as line_router
+from resources import ResourceProfile
 
 # ロギングの設定
 logging.basicConfig(
@@ -17,6 +22,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# CPUコアを同時実行ジョブで分け合う。スレッド数の環境変数はnumpyなどのimport前に設定する
+resource_profile = ResourceProfile.from_env()
+resource_profile.set_env()
+job_executor = ThreadPoolExecutor(max_workers=resource_profile.concurrent_jobs)
+
 app = FastAPI()
 
 app.add_middleware(
@@ -28,38 +38,284 @@ app.add_middleware(
 )
 
 
+# 起動時間を短くするため、face_processor以下の重いモジュールはバックグラウンドで読み込む
+HEAVY_MODULES = ["numpy", "cv2", "dlib", "scipy.ndimage", "face_processor"]
+if os.getenv("EMOTION_BACKEND", "feat") == "feat":
+    HEAVY_MODULES += ["torch", "feat"]
+else:
+    HEAVY_MODULES += ["onnxruntime"]
+
+# ジョブごとに動画と解析結果を保存し、再起動時に途中から再開できるようにする
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+# プロセスごと落ちるジョブを再起動のたびに繰り返さないよう、実行回数に上限を設ける
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+# 設定すると長時間の動画でも上位k件の候補だけを保持するストリーミング選択を使う
+STREAMING_TOP_K = (
+    int(os.getenv("STREAMING_TOP_K")) if os.getenv("STREAMING_TOP_K") else None
+)
+
+# 設定すると解析中に確定したベストショットを最大この枚数まで逐次アップロードする
+ALBUM_SIZE = int(os.getenv("ALBUM_SIZE")) if os.getenv("ALBUM_SIZE") else None
+
+# ジョブの状態（負荷試験などで処理時間を計測するために使う）
+job_status = {}
+# 終了したジョブの状態を残しておく秒数
+JOB_STATUS_TTL = float(os.getenv("JOB_STATUS_TTL", "3600"))
+
+warmup_state = {"ready": False, "error": None, "import_times": {}, "warmup_time": None}
+smile_detector = None
+smile_detector_lock = threading.Lock()
+
+
+def get_smile_detector():
+    """ジョブ間で共有する笑顔判定モデルを返す（初回のみ読み込む）"""
+    global smile_detector
+    with smile_detector_lock:
+        if smile_detector is None:
+            from smile_detect import EmotionDetector
+
+            backend = os.getenv("EMOTION_BACKEND", "feat")
+            smile_detector = EmotionDetector(
+                backend=backend,
+                onnx_model_path=os.getenv("EMOTION_ONNX_MODEL"),
+                onnx_session_options=(
+                    resource_profile.session_options() if backend == "onnx" else None
+                ),
+            )
+        return smile_detector
+
+
+def warmup_models():
+    """重いモジュールのimportとモデルの読み込みを行い、所要時間を記録する"""
+    start = time.perf_counter()
+    try:
+        for name in HEAVY_MODULES:
+            module_start = time.perf_counter()
+            importlib.import_module(name)
+            warmup_state["import_times"][name] = round(
+                time.perf_counter() - module_start, 3
+            )
+        resource_profile.apply()
+
+        from face_processor import load_shape_predictor
+
+        load_shape_predictor("src/shape_predictor_68_face_landmarks.dat")
+        get_smile_detector()
+    except Exception as e:
+        warmup_state["error"] = str(e)
+        logger.error(f"モデルのウォームアップ中にエラーが発生: {str(e)}")
+        return
+
+    warmup_state["warmup_time"] = round(time.perf_counter() - start, 3)
+    warmup_state["ready"] = True
+    logger.info(
+        f"ウォームアップ完了: {warmup_state['warmup_time']}秒, "
+        f"import時間: {warmup_state['import_times']}"
+    )
+
+
+def prune_job_status():
+    """終了してから JOB_STATUS_TTL 秒を過ぎたジョブの状態を削除する"""
+    expires = time.time() - JOB_STATUS_TTL
+    # 処理中のスレッドが状態を追加するため、コピーを走査する
+    for process_id, status in list(job_status.items()):
+        if status.get("finished_at", expires) < expires:
+            job_status.pop(process_id, None)
+
+
+def write_job(job_dir, job):
+    # 書き込み途中で落ちても壊れたjob.jsonが残らないよう、一時ファイルから置き換える
+    job_path = os.path.join(job_dir, "job.json")
+    with open(f"{job_path}.tmp", "w") as job_file:
+        json.dump(job, job_file)
+    os.replace(f"{job_path}.tmp", job_path)
+
+
+def resume_jobs():
+    """前回の起動時に完了しなかったジョブを再開する
+
+    アップロードの受付前に呼び、起動後に作られたジョブを二重に実行しないようにする。
+    """
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for process_id in sorted(os.listdir(JOBS_DIR)):
+        job_dir = os.path.join(JOBS_DIR, process_id)
+        job_path = os.path.join(job_dir, "job.json")
+        if process_id in job_status or not os.path.exists(job_path):
+            continue
+        with open(job_path) as f:
+            job = json.load(f)
+        attempts = job.get("attempts", 1)
+        if attempts >= MAX_JOB_ATTEMPTS:
+            logger.error(f"実行回数の上限に達したため破棄します: {process_id}")
+            job_status[process_id] = {
+                "status": "error",
+                "error": f"Gave up after {attempts} attempts.",
+                "finished_at": time.time(),
+            }
+            remove_job_dir(job_dir)
+            continue
+        job["attempts"] = attempts + 1
+        write_job(job_dir, job)
+
+        logger.info(f"未完了のジョブを再開します: {process_id} ({attempts + 1}回目)")
+        job_status[process_id] = {"status": "queued", "queued_at": time.time()}
+        if "videos" in job:
+            submit_batch(job_dir, process_id, job["decoder"], job["videos"])
+        else:
+            job_executor.submit(process_video_task, job_dir, process_id, job["decoder"])
+
+
+@app.on_event("startup")
+async def on_startup():
+    threading.Thread(target=warmup_models, daemon=True).start()
+    # ジョブディレクトリの一覧は起動処理の中で作り、処理はjob_executorで行う
+    resume_jobs()
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def ready():
+    status_code = 200 if warmup_state["ready"] else 503
+    return JSONResponse(status_code=status_code, content=warmup_state)
+
+
+@app.get("/jobs/{process_id}")
+async def get_job(process_id: str):
+    if process_id not in job_status:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job_status[process_id]
+
+
 # LINE Bot
 app.include_router(line_router)
 
 
-def process_video_task(video_path: str, process_id: str):
+def create_processor(video_path, process_id, decoder, job_dir, album_size=None):
+    resource_profile.apply()
+    from face_processor import FaceProcessor
+
+    return FaceProcessor(
+        video_path,
+        id=process_id,
+        smile_detector=get_smile_detector(),
+        decoder=decoder,
+        decoder_options=resource_profile.decoder_options(),
+        job_dir=job_dir,
+        streaming_top_k=STREAMING_TOP_K,
+        album_size=album_size,
+    )
+
+
+def remove_job_dir(job_dir):
+    # ジョブディレクトリを削除（プロセスが落ちた場合は残り、次回起動時に再開される）
+    try:
+        if os.path.exists(job_dir):
+            shutil.rmtree(job_dir)
+            logger.info(f"ジョブディレクトリ削除: {job_dir}")
+    except Exception as e:
+        logger.error(f"ジョブディレクトリの削除中にエラーが発生: {str(e)}")
+
+
+def process_video_task(job_dir: str, process_id: str, decoder: str):
     """動画の処理を非同期で実行する関数"""
+    status = job_status.setdefault(process_id, {"queued_at": time.time()})
+    status.update(status="running", started_at=time.time())
     try:
-        face_processor = FaceProcessor(video_path, id=process_id)
+        face_processor = create_processor(
+            os.path.join(job_dir, "video.mp4"),
+            process_id,
+            decoder,
+            job_dir,
+            album_size=ALBUM_SIZE,
+        )
         face_processor.process_video()
+        status["status"] = "done"
     except Exception as e:
+        status.update(status="error", error=str(e))
         logger.error(f"動画処理中にエラーが発生: {str(e)}")
     finally:
-        # 一時ファイルを削除
-        try:
-            if os.path.exists(video_path):
-                os.remove(video_path)
-                logger.info(f"一時ファイル削除: {video_path}")
-        except Exception as e:
-            logger.error(f"一時ファイルの削除中にエラーが発生: {str(e)}")
+        status["finished_at"] = time.time()
+        remove_job_dir(job_dir)
+
+
+def submit_batch(job_dir, process_id, decoder, videos):
+    """動画ごとの解析をスケジューラーに登録する（アルバムは最後の動画の解析後に作る）"""
+    from batch import BatchJob
+
+    batch = BatchJob(process_id, job_dir, videos)
+    for index in range(len(videos)):
+        job_executor.submit(process_batch_video_task, batch, index, decoder)
+
+
+def process_batch_video_task(batch, index: int, decoder: str):
+    status = job_status.setdefault(batch.album_id, {"queued_at": time.time()})
+    status.setdefault("started_at", time.time())
+    status["status"] = "running"
+    video = batch.videos[index]
+    processor = None
+    try:
+        # 動画ごとに解析結果を保存し、再開時は解析済みの動画を読み込むだけにする
+        processor = create_processor(
+            os.path.join(batch.job_dir, video),
+            batch.album_id,
+            decoder,
+            os.path.join(batch.job_dir, os.path.splitext(video)[0]),
+        )
+        processor.analyze()
+    except Exception as e:
+        logger.error(f"動画処理中にエラーが発生: {video}: {str(e)}")
+        # 成功した動画はアルバム作成でフレームを読むため、finish_batch_taskで閉じる
+        if processor is not None:
+            processor.close()
+        last = batch.finish_video(index, error=str(e))
+    else:
+        last = batch.finish_video(index, processor)
+    if last:
+        job_executor.submit(finish_batch_task, batch)
+
+
+def finish_batch_task(batch):
+    """全動画の候補をまとめて笑顔判定し、1つのアルバムにアップロードする"""
+    from batch import build_album
+
+    status = job_status[batch.album_id]
+    try:
+        if len(batch.errors) == len(batch.videos):
+            raise RuntimeError("; ".join(batch.errors))
+        uploaded = build_album(batch.processors, get_smile_detector())
+        logger.info(f"アルバム作成完了: {batch.album_id}, {uploaded}枚")
+        status["status"] = "done"
+        if batch.errors:
+            status["errors"] = batch.errors
+    except Exception as e:
+        status.update(status="error", error=str(e))
+        logger.error(f"アルバム作成中にエラーが発生: {str(e)}")
+    finally:
+        for processor in batch.processors:
+            if processor is not None:
+                processor.close()
+        status["finished_at"] = time.time()
+        remove_job_dir(batch.job_dir)
 
 
 @app.post("/upload")
-async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_video(
+    file: UploadFile = File(...),
+    decoder: str = os.getenv("VIDEO_DECODER", "opencv"),
+):
     logger.info(
         f"ファイルアップロード開始: {file.filename}, content_type: {file.content_type}"
     )
 
+    if decoder not in ("opencv", "pyav"):
+        logger.error(f"不正なデコーダー: {decoder}")
+        raise HTTPException(status_code=400, detail="Invalid decoder.")
+
     if not file.content_type.startswith("video/"):
         logger.error(f"不正なファイル形式: {file.content_type}")
         raise HTTPException(
@@ -68,18 +324,24 @@ async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = Fil
 
     process_id = (str(ULID())).lower()
 
-    # アップロードされた動画を一時ファイルに保存
-    with NamedTemporaryFile(delete=False, suffix=".mp4") as temp_file:
+    # アップロードされた動画をジョブディレクトリに保存
+    job_dir = os.path.join(JOBS_DIR, process_id)
+    os.makedirs(job_dir, exist_ok=True)
+    video_path = os.path.join(job_dir, "video.mp4")
+    with open(video_path, "wb") as video_file:
         content = await file.read()
-        temp_file.write(content)
-        temp_file_path = temp_file.name
-        logger.info(f"一時ファイルに保存: {temp_file_path}")
+        video_file.write(content)
+        logger.info(f"ジョブディレクトリに保存: {video_path}")
+    # 動画の保存が終わってからジョブ情報を書き、再開対象にする
+    write_job(job_dir, {"decoder": decoder, "attempts": 1})
 
-    # 動画処理をバックグラウンドで実行
-    background_tasks.add_task(process_video_task, temp_file_path, process_id)
+    # 動画処理をバックグラウンドで実行（同時実行数はresource_profileで制限する）
+    prune_job_status()
+    job_status[process_id] = {"status": "queued", "queued_at": time.time()}
+    job_executor.submit(process_video_task, job_dir, process_id, decoder)
 
     # DEBUG: バックグラウンドじゃない処理
-    # face_processor = FaceProcessor(temp_file_path, id=process_id)
+    # face_processor = FaceProcessor(video_path, id=process_id)
     # face_processor.process_video()
 
     # クライアントには即座にレスポンスを返す
@@ -89,6 +351,52 @@ async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = Fil
     )
 
 
+@app.post("/upload/batch")
+async def upload_videos(
+    files: list[UploadFile] = File(...),
+    decoder: str = os.getenv("VIDEO_DECODER", "opencv"),
+):
+    """複数の動画を1つのアルバムとして処理する"""
+    logger.info(f"一括アップロード開始: {[file.filename for file in files]}")
+
+    if decoder not in ("opencv", "pyav"):
+        logger.error(f"不正なデコーダー: {decoder}")
+        raise HTTPException(status_code=400, detail="Invalid decoder.")
+
+    for file in files:
+        if not file.content_type.startswith("video/"):
+            logger.error(f"不正なファイル形式: {file.content_type}")
+            raise HTTPException(
+                status_code=400, detail="Invalid file type. Expected video."
+            )
+
+    process_id = (str(ULID())).lower()
+
+    job_dir = os.path.join(JOBS_DIR, process_id)
+    os.makedirs(job_dir, exist_ok=True)
+    videos = []
+    for index, file in enumerate(files):
+        video = f"video_{index:02d}.mp4"
+        with open(os.path.join(job_dir, video), "wb") as video_file:
+            video_file.write(await file.read())
+        videos.append(video)
+    logger.info(f"ジョブディレクトリに保存: {job_dir}, {len(videos)}本")
+    write_job(job_dir, {"decoder": decoder, "videos": videos, "attempts": 1})
+
+    prune_job_status()
+    job_status[process_id] = {"status": "queued", "queued_at": time.time()}
+    submit_batch(job_dir, process_id, decoder, videos)
+
+    return JSONResponse(
+        status_code=200,
+        content={
+            "process_id": process_id,
+            "videos": len(videos),
+            "message": "Video processing started",
+        },
+    )
+
+
 if __name__ == "__main__":
     logger.info("サーバーを起動します")
     uvicorn.run("server:app", host="0.0.0.0", port=5000, reload=True)
@@ -3,19 +3,176 @@ import tempfile
 
 import cv2
 import numpy as np
-import torch
-from feat import Detector
 from PIL import Image
 
+# py-feat (resmasknet) の感情ラベル順
+EMOTION_LABELS = [
+    "anger",
+    "disgust",
+    "fear",
+    "happiness",
+    "sadness",
+    "surprise",
+    "neutral",
+]
+# resmasknetの入力サイズ
+RESMASKNET_SIZE = 224
 
-class EmotionDetector:
-    def __init__(self, device=None):
-        self.device = (
-            device if device else ("cuda" if torch.cuda.is_available() else "cpu")
+
+def crop_face(image, box, width, height, channels=3, expand=1.1):
+    # py-feat (ResMaskNet._batch_make) と同様に、顔領域を正方形に1.1倍拡張して切り出し、
+    # グレースケールを3チャンネルに複製して0〜1に正規化する
+    left, top, right, bottom = box
+    cx, cy = (left + right) / 2, (top + bottom) / 2
+    half = max(right - left, bottom - top) * expand / 2
+    h, w = image.shape[:2]
+    x1, y1 = max(0, int(cx - half)), max(0, int(cy - half))
+    x2, y2 = min(w, int(cx + half)), min(h, int(cy + half))
+    face = image[y1:y2, x1:x2]
+    if face.size == 0:
+        return None
+
+    face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+    face = cv2.resize(face, (width, height))[np.newaxis]
+    if channels != 1:
+        face = np.repeat(face, channels, axis=0)
+    return face.astype(np.float32) / 255.0
+
+
+def classify_in_batches(items, crop, run, max_batch=32):
+    """(画像, 顔領域) のリストの全ての顔を max_batch 件ずつ run で推論し、画像ごとの感情確率を返す"""
+    crops, counts = [], []
+    for image, faces in items:
+        image_crops = [crop(image, box) for box in faces]
+        image_crops = [c for c in image_crops if c is not None]
+        crops.extend(image_crops)
+        counts.append(len(image_crops))
+    if not crops:
+        return [np.empty((0, len(EMOTION_LABELS)), dtype=np.float32)] * len(items)
+    emotions = np.concatenate(
+        [
+            run(np.stack(crops[i : i + max_batch]))
+            for i in range(0, len(crops), max_batch)
+        ]
+    )
+    return np.split(emotions, np.cumsum(counts)[:-1])
+
+
+class OnnxEmotionClassifier:
+    """int8量子化済みONNX感情分類モデルを顔画像に対して実行するクラス"""
+
+    def __init__(self, model_path, session_options=None):
+        import onnxruntime as ort
+
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=session_options,
+            providers=["CPUExecutionProvider"],
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        _, self.channels, self.height, self.width = model_input.shape
+        self.face_detector = None
+
+    def detect_faces(self, image):
+        # 顔領域が渡されなかった場合のみdlibで検出する
+        if self.face_detector is None:
+            import dlib
+
+            self.face_detector = dlib.get_frontal_face_detector()
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return [
+            (rect.left(), rect.top(), rect.right(), rect.bottom())
+            for rect in self.face_detector(gray, 0)
+        ]
+
+    def crop_face(self, image, box, expand=1.1):
+        return crop_face(image, box, self.width, self.height, self.channels, expand)
+
+    def predict(self, image, faces=None):
+        """顔ごとの感情確率 (N, 7) を返す"""
+        if faces is None:
+            faces = self.detect_faces(image)
+        crops = [self.crop_face(image, box) for box in faces]
+        crops = [crop for crop in crops if crop is not None]
+        if not crops:
+            return np.empty((0, len(EMOTION_LABELS)), dtype=np.float32)
+        return self.session.run(None, {self.input_name: np.stack(crops)})[0]
+
+    def predict_batch(self, items, max_batch=32):
+        """(画像, 顔領域) のリストの全ての顔をまとめて推論し、画像ごとの感情確率を返す"""
+        items = [
+            (image, self.detect_faces(image) if faces is None else faces)
+            for image, faces in items
+        ]
+        return classify_in_batches(
+            items,
+            self.crop_face,
+            lambda batch: self.session.run(None, {self.input_name: batch})[0],
+            max_batch,
         )
-        self.detector = self._initialize_detector()
+
+
+def export_onnx_model(output_path, device="cpu", quantize=True):
+    """py-featのresmasknetをONNXに書き出し、int8に量子化する"""
+    import torch
+
+    detector = EmotionDetector(device=device)
+    model = detector.emotion_network()
+
+    float_path = output_path if not quantize else f"{output_path}.fp32.onnx"
+    torch.onnx.export(
+        model,
+        torch.zeros(1, 3, RESMASKNET_SIZE, RESMASKNET_SIZE, device=device),
+        float_path,
+        input_names=["face"],
+        output_names=["emotions"],
+        dynamic_axes={"face": {0: "batch"}, "emotions": {0: "batch"}},
+        opset_version=17,
+    )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # ConvIntegerはCPU実行時にuint8の重みが必要
+        quantize_dynamic(float_path, output_path, weight_type=QuantType.QUInt8)
+        os.remove(float_path)
+    print(f"ONNXモデルを書き出しました: {output_path}")
+
+
+class EmotionDetector:
+    def __init__(
+        self,
+        device=None,
+        backend="feat",
+        onnx_model_path=None,
+        onnx_session_options=None,
+    ):
+        self.device = device
+        self.backend = backend
+        self._emotion_network = None
+        if backend == "onnx":
+            if onnx_model_path is None:
+                raise ValueError("ONNXバックエンドにはモデルのパスが必要です。")
+            self.detector = None
+            self.classifier = OnnxEmotionClassifier(
+                onnx_model_path, onnx_session_options
+            )
+        elif backend == "feat":
+            if self.device is None:
+                import torch
+
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.detector = self._initialize_detector()
+            self.classifier = None
+        else:
+            raise ValueError(f"未対応のバックエンドです: {backend}")
 
     def _initialize_detector(self):
+        # torchとpy-featは読み込みが重いため、必要になるまでimportしない
+        import torch
+        from feat import Detector
+
         detector = Detector(
             face_model="retinaface",
             landmark_model="mobilefacenet",
@@ -32,6 +189,38 @@ class EmotionDetector:
 
         return detector
 
+    def emotion_network(self):
+        """py-featのresmasknetに確率を出すSoftmaxをつなげたモデルを返す"""
+        if self._emotion_network is None:
+            import torch
+
+            emotion_model = self.detector.emotion_model
+            model = getattr(emotion_model, "model", emotion_model)
+            self._emotion_network = torch.nn.Sequential(
+                model, torch.nn.Softmax(dim=1)
+            ).eval()
+        return self._emotion_network
+
+    def predict_batch(self, items, max_batch=32):
+        """顔領域つきの画像のリストについて、全ての顔をまとめて感情を推論する"""
+        if self.backend == "onnx":
+            return self.classifier.predict_batch(items, max_batch)
+
+        import torch
+
+        network = self.emotion_network()
+
+        def run(batch):
+            with torch.no_grad():
+                return network(torch.from_numpy(batch).to(self.device)).cpu().numpy()
+
+        return classify_in_batches(
+            items,
+            lambda image, box: crop_face(image, box, RESMASKNET_SIZE, RESMASKNET_SIZE),
+            run,
+            max_batch,
+        )
+
     def process_image(self, image):
         try:
             if isinstance(image, np.ndarray):
@@ -66,6 +255,16 @@ class EmotionDetector:
 
         return valid_faces, smiling_faces
 
+    def analyze_faces(self, image, faces=None, smile_label="happiness"):
+        """ONNXバックエンドで顔ごとに分類し、analyze_emotionsと同じ形式で返す"""
+        return self.count_smiles(self.classifier.predict(image, faces), smile_label)
+
+    def count_smiles(self, emotions, smile_label="happiness"):
+        smile_index = EMOTION_LABELS.index(smile_label)
+        valid_faces = len(emotions)
+        smiling_faces = int(np.sum(np.argmax(emotions, axis=1) == smile_index))
+        return valid_faces, smiling_faces
+
     def save_smiling_faces(self, image, valid_faces, smiling_faces, output_path):
         if valid_faces > 0 and smiling_faces / valid_faces >= 0.7:
             if isinstance(image, Image.Image):
@@ -92,11 +291,19 @@ class EmotionDetector:
         else:
             print("笑顔の閾値を満たさなかったため、画像は保存されませんでした。")
 
-    def process_single_image2(self, image):
+    def process_single_image2(self, image, faces=None):
         if image is None:
             print("画像が無効です。")
             return False
 
+        if self.backend == "onnx":
+            try:
+                valid_faces, smiling_faces = self.analyze_faces(image, faces)
+            except Exception as e:
+                print(f"画像処理中にエラーが発生しました: {e}")
+                return False
+            return valid_faces > 0 and smiling_faces / valid_faces >= 0.7
+
         prediction = self.process_image(image)
         if prediction is None:
             return False
@@ -105,8 +312,39 @@ class EmotionDetector:
 
         return valid_faces > 0 and smiling_faces / valid_faces >= 0.7
 
+    def process_batch(self, items):
+        """(画像, 顔領域) のリストを判定する。全画像の顔をまとめて感情モデルに通す
+
+        py-featで顔領域が渡されなかった画像だけは、顔検出から1枚ずつ判定する。
+        """
+        results = [None] * len(items)
+        batched = []
+        for i, (image, faces) in enumerate(items):
+            if faces is None and self.backend != "onnx":
+                results[i] = self.process_single_image2(image)
+            else:
+                batched.append(i)
+        if not batched:
+            return results
+
+        try:
+            emotions = self.predict_batch([items[i] for i in batched])
+        except Exception as e:
+            print(f"画像処理中にエラーが発生しました: {e}")
+            emotions = [np.empty((0, len(EMOTION_LABELS)))] * len(batched)
+        for i, image_emotions in zip(batched, emotions):
+            valid_faces, smiling_faces = self.count_smiles(image_emotions)
+            results[i] = valid_faces > 0 and smiling_faces / valid_faces >= 0.7
+        return results
+
 
 if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--export-onnx":
+        export_onnx_model(sys.argv[2])
+        sys.exit(0)
+
     image_path = "src/output_frames/frame_000740.png"
     output_path = "src/output_images/smiling_face.png"
 
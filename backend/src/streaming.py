@@ -0,0 +1,100 @@
+import heapq
+from collections import deque
+
+import numpy as np
+
+
+def gaussian_weights(sigma, truncate=4.0):
+    # scipy.ndimage.gaussian_filter1d と同じ重み
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 / (sigma * sigma) * x**2)
+    return (weights / weights.sum())[radius:].tolist()
+
+
+class StreamingPeakSelector:
+    """平滑化したスコアの極大フレームを逐次検出し、上位k件だけを保持する
+
+    gaussian_filter1d (mode="reflect") と同じ平滑化を幅 2*radius+1 の窓で行うため、
+    メモリ使用量は動画の長さによらず O(k + radius) となる。
+    on_peak を渡すと、極大が確定した時点で (frame_no, score, payload) を通知する。
+    """
+
+    def __init__(self, k=50, sigma=2, truncate=4.0, keep_ratio=0.7, on_peak=None):
+        self.k = k
+        self.on_peak = on_peak
+        self.keep_ratio = keep_ratio
+        self.weights = gaussian_weights(sigma, truncate)
+        self.radius = len(self.weights) - 1
+        # 先頭の反射に使う最初の値と、直近の窓
+        self.head = []
+        self.window = deque(maxlen=2 * self.radius + 1)
+        self.count = 0
+        self.emitted = 0
+        self.previous = None
+        self.rising = False
+        self.heap = []
+        self.peak_count = 0
+
+    def value_at(self, index):
+        # 範囲外のインデックスは mode="reflect" と同様に折り返す
+        index %= 2 * self.count
+        if index >= self.count:
+            index = 2 * self.count - 1 - index
+        if index < len(self.head):
+            return self.head[index][1]
+        return self.window[index - (self.count - len(self.window))][1]
+
+    def smooth(self, index):
+        # scipyの対称カーネルと同じ順序で加算し、結果を一致させる
+        total = self.value_at(index) * self.weights[0]
+        for j in range(self.radius, 0, -1):
+            total += (
+                self.value_at(index - j) + self.value_at(index + j)
+            ) * self.weights[j]
+        return total
+
+    def push(self, frame_no, value, payload=None):
+        entry = (frame_no, float(value), payload)
+        if len(self.head) <= self.radius:
+            self.head.append(entry)
+        self.window.append(entry)
+        self.count += 1
+        # 右側の窓が揃ったフレームから平滑化値を確定する
+        while self.emitted + self.radius < self.count:
+            self.emit(self.emitted)
+
+    def emit(self, index):
+        offset = index - (self.count - len(self.window))
+        frame_no, _, payload = self.head[index] if offset < 0 else self.window[offset]
+        self.emitted += 1
+        self.observe(frame_no, self.smooth(index), payload)
+
+    def observe(self, frame_no, smoothed, payload):
+        # 直前の値より増加した後に減少したら、直前のフレームを極大とする
+        if self.previous is not None:
+            prev_frame, prev_value, prev_payload = self.previous
+            diff = smoothed - prev_value
+            if self.rising and diff < 0:
+                self.add_peak(prev_frame, prev_value, prev_payload)
+            self.rising = diff > 0
+        self.previous = (frame_no, smoothed, payload)
+
+    def add_peak(self, frame_no, score, payload):
+        self.peak_count += 1
+        if self.on_peak is not None:
+            self.on_peak(frame_no, score, payload)
+        # 同点の場合は先に現れたフレームを残す
+        item = (score, -frame_no, payload)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        elif item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def finish(self):
+        """残りのフレームを確定し、上位の極大フレームを (frame_no, payload) で返す"""
+        while self.emitted < self.count:
+            self.emit(self.emitted)
+        ranked = sorted(self.heap, key=lambda item: (-item[0], -item[1]))
+        ranked = ranked[: int(self.peak_count * self.keep_ratio)]
+        return [(-neg_frame, payload) for _, neg_frame, payload in ranked]
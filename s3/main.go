@@ -57,6 +57,11 @@ func (mc *MinioClient) UploadImage(bucket, objectName string, file io.Reader, fi
 	return err
 }
 
+func (mc *MinioClient) DeleteImage(bucket, objectName string) error {
+	log.Printf("Deleting image from bucket: %s, object name: %s", bucket, objectName)
+	return mc.client.RemoveObject(context.Background(), bucket, objectName, minio.RemoveObjectOptions{})
+}
+
 func (mc *MinioClient) GetPresignedURLs(bucket string) ([]string, error) {
 	log.Printf("Fetching presigned URLs for bucket: %s", bucket)
 	var urls []string
@@ -169,6 +174,17 @@ func main() {
 		encoder.Encode(gin.H{"images": urls})
 	})
 
+	r.DELETE("/images", func(c *gin.Context) {
+		bucket := c.Query("bucket")
+		name := c.Query("name")
+		if err := minioClient.DeleteImage(bucket, name); err != nil {
+			log.Printf("Delete failed: %v", err)
+			c.JSON(http.StatusInternalServerError, gin.H{"error": err.Error()})
+			return
+		}
+		c.JSON(http.StatusOK, gin.H{"message": "Delete successful"})
+	})
+
 	r.GET("/download", func(c *gin.Context) {
 		bucket := c.Query("bucket")
 		zipBuffer, err := minioClient.DownloadAllImages(bucket)